@@ -28,3 +28,5 @@
 """
 STELM Formatting engine. See combinator.py for entry point.
 """
+
+from combinator import warmup # call in a pre-forking server's parent; see combinator.warmup()
@@ -0,0 +1,185 @@
+# encoding: utf-8
+
+# Copyright 2010 by Dmitry Cheryasov. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are
+# permitted provided that the following conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright notice, this list of
+#       conditions and the following disclaimer.
+#
+#    2. Redistributions in binary form must reproduce the above copyright notice, this list
+#       of conditions and the following disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL COPYRIGHT HOLDER BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# ^^^ This is the "Simplified BSD License"
+
+
+"""
+Batched lookups for formatters whose output depends on an external service, e.g. a tag table.
+
+A formatter that needs a lookup puts a Deferred into its fragment list instead of final strings.
+After the whole document is parsed, resolveDeferred() asks every resolver once for all the keys
+it has collected, and replaces each Deferred with the fragments it renders from the answer.
+"""
+
+import time
+from collections import OrderedDict
+from threading import Lock
+
+_MISSING = object()
+
+
+class LRUCache(object):
+  """
+  Bounded mapping that evicts the least recently used entry when full.
+  Safe to share between threads.
+  """
+
+  def __init__(self, size=1024):
+    self.size = size
+    self.data = OrderedDict()
+    self.lock = Lock()
+
+  def get(self, key, default=None):
+    with self.lock:
+      value = self.data.pop(key, _MISSING)
+      if value is _MISSING:
+        return default
+      self.data[key] = value # move to the most recent end
+      return value
+
+  def put(self, key, value):
+    with self.lock:
+      self.data.pop(key, None)
+      self.data[key] = value
+      while len(self.data) > self.size:
+        self.data.popitem(last=False)
+
+  def clear(self):
+    with self.lock:
+      self.data.clear()
+
+  def __len__(self):
+    return len(self.data)
+
+
+class TTLCache(LRUCache):
+  """
+  LRUCache whose entries also expire ttl seconds after they were put.
+  """
+
+  def __init__(self, size=1024, ttl=300, clock=time.time):
+    LRUCache.__init__(self, size)
+    self.ttl = ttl
+    self.clock = clock
+
+  def get(self, key, default=None):
+    entry = LRUCache.get(self, key, _MISSING)
+    if entry is _MISSING:
+      return default
+    expires, value = entry
+    if expires < self.clock():
+      with self.lock:
+        self.data.pop(key, None)
+      return default
+    return value
+
+  def put(self, key, value):
+    LRUCache.put(self, key, (self.clock() + self.ttl, value))
+
+
+class BatchResolver(object):
+  """
+  Wraps a lookup function fn(set of keys) -> {key: value} with a cache.
+  Keys the function leaves out of its answer resolve to None; that is cached, too.
+  """
+
+  def __init__(self, fn, cache=None):
+    self.fn = fn
+    if cache is None:
+      cache = LRUCache()
+    self.cache = cache
+
+  def resolve(self, keys):
+    "Returns a dict of answers for all keys, calling fn at most once for the uncached ones."
+    cache = self.cache
+    answers = {}
+    missing = set()
+    for key in keys:
+      value = cache.get(key, _MISSING)
+      if value is _MISSING:
+        missing.add(key)
+      else:
+        answers[key] = value
+    if missing:
+      found = self.fn(missing) or {}
+      for key in missing:
+        value = found.get(key)
+        cache.put(key, value)
+        answers[key] = value
+    return answers
+
+
+class Deferred(object):
+  """
+  Placeholder fragment. Once the resolver answers for key, render(answer) returns the real fragments.
+  """
+  __slots__ = ("resolver", "key", "render")
+
+  def __init__(self, resolver, key, render):
+    self.resolver = resolver
+    self.key = key
+    self.render = render
+
+
+def resolveDeferred(frags):
+  """
+  Replace every Deferred in the fragment list, calling each resolver once for all its keys.
+  Returns a new list, or frags itself if there was nothing to resolve.
+  """
+  wanted = {}
+  positions = []
+  for i, frag in enumerate(frags):
+    if frag.__class__ is Deferred:
+      positions.append(i)
+      wanted.setdefault(frag.resolver, set()).add(frag.key)
+  if not positions:
+    return frags
+  answers = dict((resolver, resolver.resolve(keys)) for resolver, keys in wanted.iteritems())
+  ret = []
+  last = 0
+  for i in positions:
+    ret.extend(frags[last:i])
+    frag = frags[i]
+    ret.extend(frag.render(answers[frag.resolver][frag.key]))
+    last = i + 1
+  ret.extend(frags[last:])
+  return ret
+
+
+class MemoryResolver(object):
+  """
+  In-memory stand-in for a lookup service, for tests and local runs.
+  Answers from a dict and records every batch of keys it was asked about.
+  """
+
+  def __init__(self, answers):
+    self.answers = dict(answers)
+    self.batches = []
+
+  def __call__(self, keys):
+    self.batches.append(frozenset(keys))
+    answers = self.answers
+    return dict((key, answers[key]) for key in keys if key in answers)
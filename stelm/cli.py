@@ -0,0 +1,221 @@
+# encoding: utf-8
+
+# Copyright 2010 by Dmitry Cheryasov. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are
+# permitted provided that the following conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright notice, this list of
+#       conditions and the following disclaimer.
+#
+#    2. Redistributions in binary form must reproduce the above copyright notice, this list
+#       of conditions and the following disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL COPYRIGHT HOLDER BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# ^^^ This is the "Simplified BSD License"
+
+
+"""
+Command-line bulk converter: python -m stelm [options] [path ...]
+
+Formats UTF-8 text files to HTML. A directory stands for all files with the given suffix under it.
+Output goes to stdout, or with -o to a directory that mirrors the input tree, with files renamed to .html;
+files that would be written to the same path, e.g. a/x.txt and b/x.txt, are refused.
+Without paths, formats records read from stdin, one per line or as delimited by -d.
+Big files are read through mmap. Files are spread over a pool of worker processes.
+Throughput and per-file timing are printed to stderr at the end.
+"""
+
+import os
+import sys
+import mmap
+import time
+import codecs
+import optparse
+from cStringIO import StringIO
+
+from combinator import initWorker, loadConfig, formatUtf8, formatTo, formatMany
+
+__all__ = ["main", "findFiles", "convertFile", "convertRecords"]
+
+MMAP_THRESHOLD = 1 << 20 # bytes; smaller files are just read
+
+
+def findFiles(paths, suffix):
+  """
+  Yields (source path, path relative to the output directory) for files named in paths
+  and for files ending with suffix in directories named in paths.
+  """
+  for path in paths:
+    if os.path.isdir(path):
+      for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for name in sorted(files):
+          if name.endswith(suffix):
+            src = os.path.join(root, name)
+            yield (src, os.path.relpath(src, path))
+    else:
+      yield (path, os.path.basename(path))
+
+def convertFile(src, dst=None):
+  """
+  Formats file src into file dst. Returns (src, size in bytes, seconds, error message or None, html):
+  html is the output if dst is None, else None.
+  """
+  started = time.time()
+  html = None
+  try:
+    f = open(src, "rb")
+    try:
+      size = os.fstat(f.fileno()).st_size
+      if size >= MMAP_THRESHOLD:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+          text = codecs.utf_8_decode(mapped, "strict", True)[0] # no copy of the bytes
+        finally:
+          mapped.close()
+        out = dst is None and StringIO() or _openOutput(dst)
+        try:
+          formatTo(text, out)
+          if dst is None:
+            html = out.getvalue()
+        finally:
+          out.close()
+      else:
+        html = formatUtf8(f.read())
+        if dst is not None:
+          out = _openOutput(dst)
+          try:
+            out.write(html)
+          finally:
+            out.close()
+          html = None
+    finally:
+      f.close()
+  except (IOError, OSError, UnicodeDecodeError), e:
+    return (src, 0, time.time() - started, str(e), None)
+  return (src, size, time.time() - started, None, html)
+
+def _openOutput(dst):
+  folder = os.path.dirname(dst)
+  if folder and not os.path.isdir(folder):
+    try:
+      os.makedirs(folder)
+    except OSError:
+      if not os.path.isdir(folder): # else another worker made it
+        raise
+  return open(dst, "wb")
+
+def _convertJob(job):
+  return convertFile(*job)
+
+def convertRecords(instream, outstream, delimiter="\n"):
+  "Formats delimited records from instream to outstream, delimited the same way. Returns (records, bytes)."
+  data = instream.read()
+  records = data.split(delimiter)
+  if records and records[-1] == "":
+    records.pop() # the delimiter ends the last record
+  docs = [record.decode("utf-8") for record in records]
+  for html in formatMany(docs):
+    outstream.write(html.encode("utf-8"))
+    outstream.write(delimiter)
+  return (len(records), len(data))
+
+def main(argv=None):
+  "Runs the converter with command-line arguments argv; returns the exit status."
+  parser = optparse.OptionParser(usage="python -m stelm [options] [path ...]", description=__doc__.split("\n\n")[1])
+  parser.add_option("-o", "--output", metavar="DIR", help="write files under DIR instead of stdout")
+  parser.add_option("-s", "--suffix", default=".txt", help="in directories, format files ending with this [%default]")
+  parser.add_option("-j", "--jobs", type="int", default=0, help="number of worker processes [number of CPUs]")
+  parser.add_option("-d", "--delimiter", default="\\n", help="record delimiter on stdin, \\n and \\0 escapes allowed [%default]")
+  parser.add_option("-c", "--config", metavar="FILE", help="JSON file to pass to combinator.configure()")
+  parser.add_option("-q", "--quiet", action="store_true", help="print no timing")
+  options, paths = parser.parse_args(argv)
+  config = loadConfig(options.config)
+  initWorker(config)
+  started = time.time()
+  if not paths:
+    delimiter = options.delimiter.replace("\\n", "\n").replace("\\0", "\0")
+    records, size = convertRecords(sys.stdin, sys.stdout, delimiter)
+    _report(sys.stderr, options.quiet, [], records, "records", size, time.time() - started)
+    return 0
+  jobs = [
+    (src, options.output and os.path.join(options.output, os.path.splitext(rel)[0] + ".html") or None)
+    for src, rel in findFiles(paths, options.suffix)
+  ]
+  if options.output:
+    jobs, error = _checkOutputs(jobs)
+    if error:
+      sys.stderr.write("stelm: %s\n" % error)
+      return 2
+  workers = options.jobs or _cpuCount()
+  if workers > 1 and len(jobs) > 1:
+    import multiprocessing
+    pool = multiprocessing.Pool(min(workers, len(jobs)), initWorker, (config,))
+    try:
+      results = pool.imap(_convertJob, jobs) # in order, so stdout output is too
+      timings = _collect(results)
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    timings = _collect(convertFile(*job) for job in jobs)
+  failed = [(src, error) for src, size, seconds, error in timings if error is not None]
+  for src, error in failed:
+    sys.stderr.write("stelm: %s: %s\n" % (src, error))
+  _report(sys.stderr, options.quiet, timings, len(timings) - len(failed), "files",
+    sum(size for src, size, seconds, error in timings), time.time() - started)
+  return failed and 1 or 0
+
+def _checkOutputs(jobs):
+  """
+  Returns (jobs without repeated ones, error message or None): an error if files of different
+  sources would be written to the same path, e.g. a/x.txt and b/x.txt both to x.html.
+  """
+  sources = {} # output path -> source
+  unique = []
+  for src, dst in jobs:
+    key = os.path.normcase(os.path.normpath(dst))
+    if key in sources:
+      if os.path.realpath(sources[key]) != os.path.realpath(src):
+        return (jobs, "%s and %s would both be written to %s" % (sources[key], src, dst))
+      continue # the same file named twice
+    sources[key] = src
+    unique.append((src, dst))
+  return (unique, None)
+
+def _collect(results):
+  "Writes the output of results meant for stdout; returns timings without it."
+  timings = []
+  for src, size, seconds, error, html in results:
+    if html is not None:
+      sys.stdout.write(html)
+    timings.append((src, size, seconds, error))
+  return timings
+
+def _cpuCount():
+  try:
+    import multiprocessing
+    return multiprocessing.cpu_count()
+  except (ImportError, NotImplementedError):
+    return 1
+
+def _report(out, quiet, timings, count, unit, size, seconds):
+  if quiet:
+    return
+  for src, file_size, file_seconds, error in timings:
+    if error is None:
+      out.write("%9.3fs %12d B  %s\n" % (file_seconds, file_size, src))
+  out.write("%d %s, %.2f MB in %.3fs, %.2f MB/s\n" % (
+    count, unit, size / 1048576.0, seconds, size / 1048576.0 / max(seconds, 1e-6)))
@@ -0,0 +1,147 @@
+# encoding: utf-8
+
+# Copyright 2010 by Dmitry Cheryasov. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are
+# permitted provided that the following conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright notice, this list of
+#       conditions and the following disclaimer.
+#
+#    2. Redistributions in binary form must reproduce the above copyright notice, this list
+#       of conditions and the following disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL COPYRIGHT HOLDER BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# ^^^ This is the "Simplified BSD License"
+
+
+"""
+Client for the render server, see server.py.
+"""
+
+import sys
+import socket
+import threading
+from Queue import Queue
+
+from server import readMessage, encodeMessage
+
+__all__ = ["Client", "RenderError"]
+
+
+class RenderError(Exception):
+  "The server answered a request with an error."
+
+
+class Client(object):
+  """
+  A connection to the render server listening at path.
+  """
+
+  def __init__(self, path, timeout=None):
+    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self.sock.settimeout(timeout)
+    self.sock.connect(path)
+    self.rfile = self.sock.makefile("rb")
+    self.wfile = self.sock.makefile("wb")
+    self.next_id = 0
+
+  def format(self, s):
+    return self.formatMany([s])[0]
+
+  def formatMany(self, docs):
+    "Returns the list of HTML for docs, rendered by the server in one request."
+    return list(self.pipeline([docs]))[0]
+
+  def pipeline(self, batches, window=16, window_bytes=8 << 20):
+    """
+    Yields the list of HTML for each list of documents in batches, in order,
+    keeping up to window requests, and up to window_bytes of them, sent ahead of the responses;
+    a request bigger than window_bytes is sent alone. Requests are sent from another thread,
+    which also iterates batches, while responses are read: the server may not read a request
+    before its response to an earlier one is read.
+    """
+    sent = Queue() # (request id, size) of requests sent, then None, or exc_info if sending failed
+    room = threading.Condition()
+    ahead = [0, 0, False] # requests and bytes sent ahead, and whether to stop sending
+
+    def write():
+      try:
+        for docs in batches:
+          request_id = self.next_id
+          self.next_id += 1
+          data = encodeMessage({"id": request_id, "docs": list(docs)})
+          with room:
+            while ahead[0] and (ahead[0] >= window or ahead[1] + len(data) > window_bytes) and not ahead[2]:
+              room.wait()
+            if ahead[2]:
+              return
+            ahead[0] += 1
+            ahead[1] += len(data)
+          self.wfile.write(data)
+          self.wfile.flush()
+          sent.put((request_id, len(data)))
+        sent.put(None)
+      except Exception:
+        sent.put(sys.exc_info())
+
+    writer = threading.Thread(target=write)
+    writer.daemon = True
+    writer.start()
+    try:
+      while True:
+        item = sent.get()
+        if item is None:
+          return
+        if len(item) == 3:
+          raise item[0], item[1], item[2]
+        request_id, size = item
+        html = self.receive(request_id)
+        with room:
+          ahead[0] -= 1
+          ahead[1] -= size
+          room.notify()
+        yield html
+    finally:
+      with room:
+        ahead[2] = True
+        room.notify()
+
+  def send(self, docs):
+    request_id = self.next_id
+    self.next_id += 1
+    self.wfile.write(encodeMessage({"id": request_id, "docs": list(docs)}))
+    self.wfile.flush()
+    return request_id
+
+  def receive(self, request_id):
+    response = readMessage(self.rfile)
+    if response is None:
+      raise RenderError("connection closed by the server")
+    if response.get("id") != request_id:
+      raise RenderError("response to request %r while waiting for %r" % (response.get("id"), request_id))
+    if "error" in response:
+      raise RenderError(response["error"])
+    return response["html"]
+
+  def close(self):
+    self.rfile.close()
+    self.wfile.close()
+    self.sock.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
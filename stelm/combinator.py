@@ -29,16 +29,328 @@
 Combines multiple formatters recursively.
 """
 
+import codecs
+import json
+import re
+import sys
+from bisect import bisect_right
 from cgi import escape as html_escape
 
-def format(s):
+from context import Context, Stats, DEFAULT_CONTEXT
+
+def format(s, with_stats=False, enable=None, disable=None):
   """
   Apply all formatters to the string and return the resulting string.
   The string is html-escaped first.
+  With with_stats, returns a tuple (string, Stats of the constructs in it).
+  enable and disable are collections of FEATURES names: only the enabled, or all but the disabled
+  formatters are applied, e.g. format(s, disable=("links",)); see variant().
+  """
+  pipeline = None
+  if enable is not None or disable is not None:
+    pipeline = variant(enable, disable)
+  if with_stats:
+    stats = Stats()
+    return (u"".join(render(s, stats, pipeline)), stats)
+  return u"".join(render(s, pipeline=pipeline))
+
+def formatText(s):
+  """
+  Like format(), but returns plain text: markup is dropped, line breaks and rules become newlines,
+  a named link is followed by its URL in parentheses.
+  """
+  return plainText(render(s))
+
+def formatBoth(s):
+  "Returns (format(s), formatText(s)) at the cost of one parse."
+  frags = render(s)
+  return (u"".join(frags), plainText(frags))
+
+def formatUtf8(data, with_stats=False):
+  """
+  Like format(), but takes and returns UTF-8 encoded bytes; data must be valid UTF-8.
+  A document that has nothing to format is html-escaped as is, without decoding it:
+  all markup is ASCII, and no byte of a multibyte UTF-8 sequence is.
+  """
+  if not with_stats and TRIGGER_RE is not None and TRIGGER_RE.search(data) is None:
+    return html_escape(data)
+  if with_stats:
+    html, stats = format(data.decode("utf-8"), with_stats)
+    return (html.encode("utf-8"), stats)
+  return format(data.decode("utf-8")).encode("utf-8")
+
+def formatTo(s, out, encoding="utf-8", stats=None):
+  """
+  Like format(), but writes the result to the file-like out, encoded, and returns the number of bytes written.
+  For large documents: neither the whole resulting string nor an escaped copy of s is built,
+  text is html-escaped a chunk at a time as it is written. Fills in stats if given.
+  """
+  return writeFragments(renderRaw(s, stats), out, encoding, True)
+
+def formatStream(reader, writer, encoding="utf-8", lookahead=None, stats=None):
+  """
+  Like formatTo(), but reads the source from the file-like reader, e.g. a file or socket.makefile(), in parts
+  and writes the result for every part as soon as nothing after it can change it; returns the number of bytes written.
+  Both sides are encoded bytes. The result is what format() gives, as long as every construct is settled
+  within lookahead characters from its start: an opener like * or {{ whose closer is farther stays literal text,
+  and a longer URL is cut. So about twice lookahead characters are held at once, however long the input is.
+  lookahead is LOOKAHEAD if None.
+  """
+  if lookahead is None:
+    lookahead = LOOKAHEAD
+  decoder = codecs.getincrementaldecoder(encoding)()
+  ctx = Context(stats, True) # positions in the source, not in its escaped copy
+  source = u"" # read and not yet written, after up to _STREAM_CONTEXT characters already written
+  pending = [] # decoded after source, joined to it once per part
+  size = 0 # characters in source and pending
+  pos = 0
+  written = 0
+  done = False
+  while not done:
+    data = reader.read(CHUNK_SIZE)
+    done = not data
+    text = decoder.decode(data, done)
+    if text:
+      pending.append(text)
+      size += len(text)
+    if not done and size - lookahead - pos < lookahead:
+      continue # read more to not search the same lookahead again and again
+    pending.insert(0, source)
+    source = u"".join(pending)
+    pending = []
+    if done:
+      stop = len(source)
+    else:
+      stop = len(source) - lookahead # what starts before this has seen lookahead characters after it
+    frags, pos = applyPart(source, pos, stop, ctx)
+    end = done and len(source) or plainUntil(source, pos, stop, ctx)
+    if pos < end:
+      frags.append(source[pos:end])
+      pos = end
+    if DEFERRING:
+      frags = resolveDeferred(frags)
+    if stats is not None:
+      stats.visible_chars += visibleChars(frags)
+    written += writeFragments(frags, writer, encoding, True)
+    keep = max(0, pos - _STREAM_CONTEXT) # e.g. the non-word before a marker, or the newline before a rule
+    source = source[keep:]
+    pos -= keep
+    size = len(source)
+  return written
+
+def formatMany(docs):
   """
-  return u"".join(applyQueue(html_escape(s)))
+  Returns [format(s) for s in docs], but faster for many short documents.
+  Identical documents are formatted once. One scan over all documents finds those
+  with nothing any formatter could match; these are html-escaped together.
+  """
+  results = {}
+  unique = []
+  for s in docs:
+    if s not in results:
+      results[s] = None
+      unique.append(s)
+  if TRIGGER_RE is None:
+    plain, marked = [], unique
+  else:
+    # no trigger pattern can match across the separator, so each hit belongs to one document
+    offsets = []
+    pos = 0
+    for s in unique:
+      offsets.append(pos)
+      pos += len(s) + 1
+    joined = _SEPARATOR.join(unique)
+    marked_indexes = set()
+    hit = TRIGGER_RE.search(joined)
+    while hit is not None:
+      i = bisect_right(offsets, hit.start()) - 1
+      marked_indexes.add(i)
+      if i + 1 == len(offsets):
+        break
+      hit = TRIGGER_RE.search(joined, offsets[i + 1]) # skip the rest of this document
+    marked = [unique[i] for i in sorted(marked_indexes)]
+    plain = [s for i, s in enumerate(unique) if i not in marked_indexes]
+  if plain:
+    escaped = html_escape(_SEPARATOR.join(plain)).split(_SEPARATOR)
+    if len(escaped) != len(plain): # the separator was in some document
+      escaped = [html_escape(s) for s in plain]
+    for s, html in zip(plain, escaped):
+      results[s] = u"" + html
+  for s in marked:
+    results[s] = format(s)
+  return [results[s] for s in docs]
+
+def render(s, stats=None, pipeline=None):
+  """
+  Returns the list of fragments for s, ready to be joined. Fills in stats if given.
+  pipeline is a Pipeline from variant(), or None for the configured formatters.
+  """
+  if pipeline is None:
+    trigger_re, deferring = TRIGGER_RE, DEFERRING
+  else:
+    trigger_re, deferring = pipeline.trigger_re, pipeline.deferring
+  if trigger_re is not None and trigger_re.search(s) is None:
+    # nothing to format
+    frags = s and [html_escape(s)] or []
+    if stats is not None:
+      stats.visible_chars = len(s)
+    return frags
+  if ESCAPE_ON_EMIT:
+    frags = applyQueue(s, Context(stats, True, pipeline))
+  elif stats is None and pipeline is None:
+    frags = applyQueue(html_escape(s))
+  else:
+    frags = applyQueue(html_escape(s), Context(stats, False, pipeline))
+  if deferring:
+    frags = resolveDeferred(frags)
+  if ESCAPE_ON_EMIT and ("&" in s or "<" in s or ">" in s):
+    frags = [frag if frag.__class__ in (Tag, Escaped) else html_escape(frag) for frag in frags]
+  if stats is not None:
+    stats.visible_chars = len(unescape(u"".join([frag for frag in frags if frag.__class__ is not Tag])))
+  return frags
 
-def applyQueue(s):
+def renderRaw(s, stats=None, pipeline=None):
+  """
+  Like render(), but text fragments are left as in s, not html-escaped; see writeFragments().
+  """
+  if pipeline is None:
+    trigger_re, deferring = TRIGGER_RE, DEFERRING
+  else:
+    trigger_re, deferring = pipeline.trigger_re, pipeline.deferring
+  if trigger_re is not None and trigger_re.search(s) is None:
+    frags = s and [s] or []
+  else:
+    frags = applyQueue(s, Context(stats, True, pipeline))
+    if deferring:
+      frags = resolveDeferred(frags)
+  if stats is not None:
+    stats.visible_chars = visibleChars(frags)
+  return frags
+
+def visibleChars(frags):
+  "Number of characters of text in fragments from renderRaw()."
+  return sum(len(unescape(frag)) if frag.__class__ is Escaped else len(frag) for frag in frags if frag.__class__ is not Tag)
+
+def configure(data_dict):
+  """
+  Configure formatters from a dict, e.g. one loaded from a config file.
+  Every formatter class that has a configure() classmethod picks the keys it knows from it.
+  Optional formatters are turned on by a dict section of their own, even an empty one, and off by None:
+  * "hashtags": HashTagger, see HashTagger.configure().
+  Engine options:
+  * "escape_on_emit": if true, formatters work on the source as is, and only the text between markup
+    gets html-escaped, instead of the whole source before formatting. The output is the same.
+  """
+  global QUEUE, DEFERRING, ESCAPE_ON_EMIT
+  if "escape_on_emit" in data_dict:
+    ESCAPE_ON_EMIT = bool(data_dict["escape_on_emit"])
+  for proc_class in set(QUEUE + OPTIONAL_FORMATTERS):
+    if hasattr(proc_class, "configure"):
+      proc_class.configure(data_dict)
+  if "hashtags" in data_dict:
+    queue = [proc_class for proc_class in QUEUE if proc_class is not HashTagger]
+    if isinstance(data_dict["hashtags"], dict):
+      queue.insert(queue.index(Linker) + 1, HashTagger)
+    QUEUE = tuple(queue)
+    prepareQueue()
+  DEFERRING = isDeferring(QUEUE)
+  _VARIANTS.clear() # may have other resolvers now
+
+def initWorker(config):
+  "configure() with config unless it is None or empty; the initializer of worker processes."
+  if config:
+    configure(config)
+
+def loadConfig(path):
+  "Returns the dict for configure() from the JSON file at path, or None if path is None or empty."
+  if not path:
+    return None
+  f = open(path)
+  try:
+    return json.load(f)
+  finally:
+    f.close()
+
+def warmup(docs=None, variants=()):
+  """
+  Builds all lazily created state for the current configuration, so that a process forked afterwards,
+  e.g. a worker of a pre-forking server, starts serving at full speed and shares it with its parent:
+  segmentation plans, the Pipeline of every (enable, disable) pair in variants, the specialized function,
+  codec lookups, and the code paths of every format function, run over docs (WARMUP_CORPUS if None).
+  Configured resolvers and code hooks are turned off meanwhile: they neither see these documents
+  nor keep answers about them. Ends with a garbage collection, so that children don't inherit
+  garbage to collect. Call again after configure(), and before serving: not thread-safe.
+  """
+  import gc
+  from StringIO import StringIO
+  import specializer
+  if docs is None:
+    docs = WARMUP_CORPUS
+  segmentPlan(STRUCTURAL)
+  pipelines = [variant(enable, disable) for enable, disable in variants]
+  for pipeline in pipelines:
+    segmentPlan(pipeline.structural)
+  specialized = specializer.specialize()
+  resolvers = {} # class that holds a resolver -> the resolver
+  for proc_class in QUEUE:
+    for owner in proc_class.__mro__:
+      if owner.__dict__.get("RESOLVER") is not None:
+        resolvers[owner] = owner.RESOLVER
+  try:
+    for owner in resolvers:
+      owner.RESOLVER = None
+    for s in docs:
+      format(s)
+      format(s, with_stats=True)
+      formatBoth(s)
+      formatUtf8(s.encode("utf-8"), with_stats=True)
+      formatTo(s, StringIO())
+      formatStream(StringIO(s.encode("utf-8")), StringIO())
+      specialized(s)
+      for enable, disable in variants:
+        format(s, enable=enable, disable=disable)
+    formatMany(docs)
+  finally:
+    for owner, resolver in resolvers.items():
+      owner.RESOLVER = resolver
+  gc.collect()
+
+def _nameSet(names):
+  if names is None:
+    return None
+  return frozenset(names)
+
+def isDeferring(queue):
+  "Returns True if some formatter in queue may put Deferred fragments into output."
+  return any(getattr(proc_class, "RESOLVER", None) is not None for proc_class in queue)
+
+def variant(enable=None, disable=None):
+  """
+  Returns the Pipeline of formatters in QUEUE that are named in enable (all if it is None)
+  and not named in disable, by their FEATURES names. Raises ValueError for an unknown name.
+  Formatters turned off by configure() stay off. Pipelines are cached until the next configure().
+  """
+  key = (QUEUE, _nameSet(enable), _nameSet(disable))
+  pipeline = _VARIANTS.get(key)
+  if pipeline is None:
+    chosen = set(QUEUE)
+    for names, keep in ((enable, True), (disable, False)):
+      if names is None:
+        continue
+      named = set()
+      for name in names:
+        if name not in FEATURES:
+          raise ValueError("Unknown feature %r, expected one of %r" % (name, sorted(FEATURES)))
+        named.update(FEATURES[name])
+      if keep:
+        chosen &= named
+      else:
+        chosen -= named
+    pipeline = Pipeline(tuple(proc_class for proc_class in QUEUE if proc_class in chosen))
+    _VARIANTS[key] = pipeline
+  return pipeline
+
+def applyQueue(s, ctx=DEFAULT_CONTEXT):
   """
   string -> list of recursively formatted substrings.
 
@@ -48,46 +360,269 @@ def applyQueue(s):
 
 
   A conforming formatter class defines three methods:
-  *  formatter(s) creates a new formatter for string s.
+  *  formatter(s, pos, ctx) creates a new formatter for string s; ctx is the Context of the document.
   *  formatter.getStart(index) -> returns the offset in s where this formatter would start
       and which is greater than index, or None, if this formatter can not format anything in s.
   *  formatter.apply(s, pos) -> (fragments, next_index). Here next_index is the position where this formatter
       finished its work. The fragments list contains strings of applied formatting, e.g. ['<b>', 'foo', '</b>'].
-      Every fragment that may contain nested formatting must be put through applyQueue() before being put
-      into the fragments list.
+      Every fragment that may contain nested formatting must be put through applyQueue(fragment, ctx)
+      before being put into the fragments list.
+
+  If the formatters allow, this is done by applySegmented(), with the same result.
   """
+  ret, pos = applyPart(s, 0, len(s), ctx)
+  if pos < len(s):
+    ret.append(s[pos:])
+  return ret
+
+def applyPart(s, pos, stop, ctx=DEFAULT_CONTEXT):
+  """
+  Does what applyQueue() does, for the part of s from pos on, with the text before pos as context,
+  but applies nothing that would start at or after stop.
+  Returns (fragments, position where they end); the position is before stop if nothing more starts before it.
+  """
+  pipeline = ctx.pipeline
+  if pipeline is None:
+    structural, lane = STRUCTURAL, LANE
+  else:
+    structural, lane = pipeline.structural, pipeline.lane
+  plan = segmentPlan(structural)
+  if plan is not None:
+    return applySegmented(s, pos, stop, ctx, plan, lane)
   ret = []
-  pos = 0
   maxlen = len(s)
-  while pos < maxlen:
+  lane_hit = None
+  while pos < stop:
     candidate = None
     bet = maxlen
-    for proc_class in QUEUE:
+    for proc_class in structural:
       # find a betting processor
-      taker = proc_class(s, pos)
+      taker = proc_class(s, pos, ctx)
       take = taker.getStart()
       if take is not None and take < bet:
         candidate = taker
         bet = take
-        if bet == 0:
+        if bet == pos:
           break # others cannot bet for less anyway
+    if bet >= stop:
+      candidate, bet = None, stop - 1 # for the lane, substitutions that start before stop
+    if lane is not None:
+      # simple substitutions don't bid; they are done in the text before the candidate
+      boundary = pos
+      pos, lane_hit, rebid = lane.apply(s, pos, bet, candidate, lane_hit, ret, ctx)
+      if rebid:
+        continue
+      if candidate is not None and pos != boundary:
+        candidate = candidate.__class__(s, pos, ctx) # same start, new boundary
     if candidate is None:
       break
     else:
       frags, pos = candidate.apply()
       ret.extend(frags)
-  if pos < maxlen:
-    ret.append(s[pos:])
-  return ret
+  return (ret, pos)
+
+def plainUntil(s, pos, stop, ctx=DEFAULT_CONTEXT):
+  """
+  Returns the position up to which, but not after stop, no match of a formatter starts in s from pos on.
+  The text from pos up to there is plain, and applyPart() from there does what it would do from pos.
+  """
+  pipeline = ctx.pipeline
+  if pipeline is None:
+    structural, lane = STRUCTURAL, LANE
+  else:
+    structural, lane = pipeline.structural, pipeline.lane
+  end = stop
+  for proc_class in structural:
+    bid = bidRegex(proc_class)
+    if bid is None:
+      start = proc_class(s, pos, ctx).getStart()
+    else:
+      hit = bid[0].search(s, pos) # a match that starts before end may need the text after it
+      start = hit and hit.start()
+    if start is not None and start < end:
+      end = start
+  if lane is not None:
+    hit = lane.regex.search(s, pos)
+    if hit is not None and hit.start() < end:
+      end = hit.start()
+  return end
+
+def applySegmented(s, pos, stop, ctx, plan, lane):
+  """
+  Does what applyPart() does, but first finds where the next opaque region, e.g. a code block,
+  starts; the other formatters only search the text before it, since whatever they find inside
+  loses the bidding to it. The text of code regions is thus never scanned by inline formatters.
+  Like in specializer.py, a formatter's last match is kept while it starts at or after pos,
+  and so is the knowledge that there is no match before some position.
+  plan is what segmentPlan() returns, lane the SubstitutionLane or None.
+
+  Searching up to the region start + MARGIN must find every match that starts before the region
+  or at its start; matches found so are searched again without a limit, to get them as they are.
+  """
+  ret = []
+  maxlen = len(s)
+  hits = [None] * len(plan) # last match of every formatter, or NO_MATCH, or None if not known
+  clear = [0] * len(plan) # no match of a formatter with no known hit starts from its last search up to this
+  lane_hit = None
+  while pos < stop:
+    limit = maxlen
+    for i, (proc_class, search, group, opaque) in enumerate(plan):
+      if opaque:
+        hit = hits[i]
+        if hit is None or hit is not NO_MATCH and hit.start() < pos:
+          hit = hits[i] = search(s, pos) or NO_MATCH
+        if hit is not NO_MATCH and hit.start(group) < limit:
+          limit = hit.start(group)
+    winner = None
+    bet = maxlen
+    for i, (proc_class, search, group, opaque) in enumerate(plan):
+      hit = hits[i]
+      if hit is None or hit is not NO_MATCH and hit.start() < pos:
+        if clear[i] > limit:
+          continue
+        if limit < maxlen:
+          hit = search(s, pos, limit + MARGIN)
+          if hit is None:
+            hits[i] = None
+            clear[i] = limit + 1
+            continue
+        hit = hits[i] = search(s, pos) or NO_MATCH
+      if hit is not NO_MATCH and hit.start(group) < bet:
+        winner = proc_class
+        bet = hit.start(group)
+        if bet == pos:
+          break # others cannot bet for less anyway
+    if bet >= stop:
+      winner, bet = None, stop - 1 # for the lane, substitutions that start before stop
+    candidate = None
+    if winner is not None:
+      candidate = winner(s, pos, ctx)
+    if lane is not None:
+      boundary = pos
+      pos, lane_hit, rebid = lane.apply(s, pos, bet, candidate, lane_hit, ret, ctx)
+      if rebid:
+        continue
+      if candidate is not None and pos != boundary:
+        candidate = winner(s, pos, ctx) # same start, new boundary
+    if candidate is None:
+      break
+    frags, pos = candidate.apply()
+    ret.extend(frags)
+  return (ret, pos)
+
+def segmentPlan(structural):
+  """
+  Returns ((formatter class, search function, group, opaque), ...) for the structural formatters,
+  from their BID and OPAQUE, for applySegmented(); None if some of them has no BID or none is OPAQUE.
+  """
+  plan = _PLANS.get(structural, NO_MATCH)
+  if plan is NO_MATCH:
+    plan = []
+    for proc_class in structural:
+      bid = bidRegex(proc_class)
+      if bid is None:
+        plan = None
+        break
+      plan.append((proc_class, bid[0].search, bid[1], getattr(proc_class, "OPAQUE", False)))
+    if plan is not None and any(opaque for proc_class, search, group, opaque in plan):
+      plan = tuple(plan)
+    else:
+      plan = None
+    _PLANS[structural] = plan
+  return plan
+
+def bidRegex(proc_class):
+  """
+  Returns (regex, group) from proc_class.BID, or None if it has none.
+  getStart() of the formatter is where that group of the leftmost match of the regex starts.
+  """
+  bid = getattr(proc_class, "BID", None)
+  if bid is None:
+    return None
+  name, group = bid
+  regex = getattr(proc_class, name, None)
+  if regex is None:
+    regex = getattr(sys.modules[proc_class.__module__], name) # e.g. a module-level regex
+  return (regex, group)
 
 
 from preformatter import BlockCodeFormatter, InlineCodeFormatter
 from linker import Linker
-from simple_substitutor import Dasher, HorizontalRuler, LineBreaker
+from simple_substitutor import Dasher, HorizontalRuler, LineBreaker, _Substitutor, SubstitutionLane
 from marker_based import Striker, Boldfacer, Italicizer
 from escaper import Escaper
-
-#from hashtagger import HashTagger
+from hashtagger import HashTagger
+from batch_resolver import resolveDeferred
+from fragments import Tag, Escaped, plainText, unescape, writeFragments, CHUNK_SIZE
 
 QUEUE = (HorizontalRuler, LineBreaker, BlockCodeFormatter, InlineCodeFormatter, Linker, Dasher, Boldfacer, Italicizer, Striker, Escaper)
 
+OPTIONAL_FORMATTERS = (HashTagger,) # not in QUEUE until enabled by configure()
+
+FEATURES = { # names for variant()
+  "rules": (HorizontalRuler,), "line_breaks": (LineBreaker,), "dashes": (Dasher,),
+  "code_blocks": (BlockCodeFormatter,), "inline_code": (InlineCodeFormatter,), "links": (Linker,), "hashtags": (HashTagger,),
+  "bold": (Boldfacer,), "italic": (Italicizer,), "strike": (Striker,), "emphasis": (Boldfacer, Italicizer, Striker),
+  "escapes": (Escaper,),
+}
+
+def splitQueue(queue):
+  """
+  Split queue into (structural formatters that bid in applyQueue(), a SubstitutionLane for simple substitutors
+  or None, a regex matching what any formatter needs to start or None). Every formatter class names that in its TRIGGER.
+  """
+  substitutors = [proc_class for proc_class in queue if issubclass(proc_class, _Substitutor)]
+  structural = tuple(proc_class for proc_class in queue if proc_class not in substitutors)
+  lane = substitutors and SubstitutionLane(substitutors, queue) or None
+  if all(hasattr(proc_class, "TRIGGER") for proc_class in queue):
+    trigger_re = re.compile("|".join(proc_class.TRIGGER for proc_class in queue) or "(?!)") # an empty queue matches nothing
+  else:
+    trigger_re = None # a formatter may match anything
+  return (structural, lane, trigger_re)
+
+def prepareQueue():
+  """
+  Split QUEUE into STRUCTURAL, LANE and TRIGGER_RE, see splitQueue().
+  Must be called after QUEUE changes.
+  """
+  global STRUCTURAL, LANE, TRIGGER_RE
+  STRUCTURAL, LANE, TRIGGER_RE = splitQueue(QUEUE)
+
+prepareQueue()
+
+
+class Pipeline(object):
+  "A subset of formatters, prepared like QUEUE is; see variant()."
+
+  def __init__(self, queue):
+    self.queue = queue
+    self.structural, self.lane, self.trigger_re = splitQueue(queue)
+    self.deferring = isDeferring(queue)
+
+_VARIANTS = {} # (QUEUE, enable, disable) -> Pipeline
+
+DEFERRING = False # True if some formatter in QUEUE may put Deferred fragments into output
+
+ESCAPE_ON_EMIT = False # see configure()
+
+_SEPARATOR = u"\0" # joins documents in formatMany()
+
+LOOKAHEAD = 1 << 20 # see formatStream()
+
+_STREAM_CONTEXT = 256 # characters kept before the current position by formatStream()
+
+NO_MATCH = object() # a formatter was searched for and found nothing
+
+MARGIN = 2 # see applySegmented()
+
+_PLANS = {} # STRUCTURAL -> segmentPlan()
+
+WARMUP_CORPUS = ( # see warmup(); every formatter, escaping and non-ASCII text
+  u"plain text, nothing to format",
+  u"*bold* _italic_ -struck- *_nested_* a -- b\nline|\n----\n",
+  u"see http://example.com/a?b=1&c=2 and http://example.org|\"the *site*\" or ftp://example.net|name",
+  u"inline {{<code> & *not bold*}} and a block:\n{{\nif a < b:\n  c = \"}}\"\n}}\n#tag #more.tags",
+  u"escaped \\*not bold\\* \\\\ caf\u00e9 \u043d\u0435\u0442-\u043d\u0435\u0442 <&> \"quotes\"",
+  u"unclosed *marker and {{ code http://",
+)
+
@@ -0,0 +1,76 @@
+# encoding: utf-8
+
+# Copyright 2010 by Dmitry Cheryasov. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are
+# permitted provided that the following conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright notice, this list of
+#       conditions and the following disclaimer.
+#
+#    2. Redistributions in binary form must reproduce the above copyright notice, this list
+#       of conditions and the following disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL COPYRIGHT HOLDER BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# ^^^ This is the "Simplified BSD License"
+
+
+"""
+Per-document state shared by all formatters working on one document.
+"""
+
+__all__ = ["Context", "Stats", "DEFAULT_CONTEXT"]
+
+
+class Stats(object):
+  """
+  Counts of constructs in a document, filled in by formatters as they apply.
+  domains maps a lowercased link host to the number of links to it.
+  """
+  __slots__ = ("links", "domains", "hashtags", "emphasis", "code_blocks", "inline_code",
+    "line_breaks", "rules", "dashes", "visible_chars")
+
+  def __init__(self):
+    self.links = self.hashtags = self.emphasis = self.code_blocks = self.inline_code = 0
+    self.line_breaks = self.rules = self.dashes = self.visible_chars = 0
+    self.domains = {}
+
+  def count(self, name):
+    "Increment the counter called name; does nothing for None."
+    if name is not None:
+      setattr(self, name, getattr(self, name) + 1)
+
+  def asDict(self):
+    return dict((name, getattr(self, name)) for name in self.__slots__)
+
+  def __repr__(self):
+    return "Stats(%s)" % ", ".join("%s=%r" % item for item in sorted(self.asDict().items()))
+
+
+class Context(object):
+  """
+  Passed to every formatter of a document and on to applyQueue() for nested parts.
+  * stats: a Stats to fill in, or None.
+  * raw: True if the source is not html-escaped; text fragments get escaped after formatting.
+  * pipeline: the combinator.Pipeline of formatters to apply, or None for the configured ones.
+  """
+  __slots__ = ("stats", "raw", "pipeline")
+
+  def __init__(self, stats=None, raw=False, pipeline=None):
+    self.stats = stats
+    self.raw = raw
+    self.pipeline = pipeline
+
+
+DEFAULT_CONTEXT = Context() # collects nothing; must not be changed
@@ -27,6 +27,8 @@
 
 import re
 
+from context import DEFAULT_CONTEXT
+
 ESC_RE = re.compile(ur"(\\.)")
 
 class Escaper(object):
@@ -34,10 +36,13 @@ class Escaper(object):
   Literal quotation formatter. A backslash quotes the following character, hiding it from further formatting.
   Does not call other formatters; must go last in the combinator queue.
   """
-  def __init__(self, s, pos):
+  TRIGGER = r"\\"
+  BID = ("ESC_RE", 0) # see specializer.py
+  def __init__(self, s, pos, ctx=DEFAULT_CONTEXT):
     "Start finding in string s at given pos"
     self.source = s
     self.boundary = pos
+    self.ctx = ctx
     hit = ESC_RE.search(s, pos)
     if hit:
       self.start = hit.start()
@@ -51,4 +56,8 @@ class Escaper(object):
   def apply(self):
     "Apply formatter; returns a tuple (list of fragments, next position)."
     source, boundary, start = self.source, self.boundary, self.start
+    if self.ctx.raw and source[start+1] in "<>&":
+      # In escaped source the backslash would quote just the "&" of an entity, and the rest of it,
+      # ending with a non-word ";", would follow as text. Leaving the char itself as text does the same.
+      return ([source[boundary:start]], start+1)
     return ([source[boundary:start], source[start+1]], start+2)
@@ -0,0 +1,199 @@
+# encoding: utf-8
+
+# Copyright 2010 by Dmitry Cheryasov. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are
+# permitted provided that the following conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright notice, this list of
+#       conditions and the following disclaimer.
+#
+#    2. Redistributions in binary form must reproduce the above copyright notice, this list
+#       of conditions and the following disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL COPYRIGHT HOLDER BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# ^^^ This is the "Simplified BSD License"
+
+
+"""
+Extraction of links, hashtags and code without building the HTML.
+
+Runs the same bidding as rendering, with the configured formatters, so a construct is found
+exactly where format() finds it: code is opaque, a backslash hides the next character,
+a link ends where Linker ends it, e.g. before the marker that closes the emphasis around it.
+Hashtags are found even if the HashTagger is not enabled. Resolvers and code hooks are not called.
+Offsets refer to the source string as given, not html-escaped.
+"""
+
+import re
+from collections import namedtuple
+
+import combinator
+from combinator import Pipeline, applyQueue, BlockCodeFormatter, InlineCodeFormatter, Linker, HashTagger
+from linker import QuoteWrapper
+from context import Context
+from marker_based import _MarkerBased
+from preformatter import _PreFormatter
+
+__all__ = ["Span", "KINDS", "extract", "extractMany"]
+
+class Span(namedtuple("Span", "kind start end value")):
+  """
+  A construct found in the source: source[start:end] is its markup, value is
+  the URL for a "link", the tag for a "hashtag", the content for "code".
+  """
+  __slots__ = ()
+
+KINDS = ("link", "hashtag", "code")
+
+def extract(s, kinds=KINDS):
+  """
+  Returns a list of Spans of given kinds found in s, in order of their start.
+  """
+  for kind in kinds:
+    if kind not in KINDS:
+      raise ValueError("Unknown kind %r, expected one of %r" % (kind, KINDS))
+  if _FOUND_RE.search(s) is None:
+    return [] # most posts: nothing to find, no need to run the formatters
+  ctx = _Recorder(_pipeline())
+  applyQueue(s, ctx)
+  return [span for span in ctx.spans if span.kind in kinds]
+
+def extractMany(docs, kinds=KINDS):
+  """
+  Bulk variant of extract(): returns a list of span lists, one per document.
+  """
+  return [extract(s, kinds) for s in docs]
+
+
+class _Recorder(Context):
+  """
+  Context of an extraction: collects Spans. base is where the string being formatted
+  starts in the document; nested parts are formatted as strings of their own.
+  """
+  __slots__ = ("spans", "base")
+
+  def __init__(self, pipeline):
+    Context.__init__(self, None, True, pipeline) # raw, so offsets are in the source
+    self.spans = []
+    self.base = 0
+
+  def record(self, kind, start, end, value):
+    self.spans.append(Span(kind, self.base + start, self.base + end, value))
+
+  def nested(self, source, start, end):
+    "Records what is in source[start:end], formatted as a string of its own, e.g. a link text."
+    if _FOUND_RE.search(source, start, end) is None:
+      return # nothing to find, no need to format it
+    self.base += start
+    applyQueue(source[start:end], self)
+    self.base -= start
+
+# The recorders find where their formatter would end, as its apply() does, and return no fragments.
+
+class _CodeRecorder(object):
+
+  def apply(self):
+    source = self.source
+    if self.start is None:
+      return ([], self.boundary)
+    innards, closing, body_start = self.findBody(source, self.end)
+    if closing is None:
+      return ([], body_start) # the unmatched marker
+    innards.append(source[body_start:closing.start()])
+    self.ctx.record("code", self.start, closing.end(), u"".join(innards))
+    return ([], closing.end())
+
+
+class _LinkRecorder(object):
+
+  def apply(self):
+    source, start, end = self.source, self.start, self.end
+    if start is None:
+      return ([], self.boundary)
+    if not self.has_text:
+      end = self.trimUrl(source, start, end)
+      self.ctx.record("link", start, end, source[start:end])
+      return ([], end)
+    self.ctx.record("link", start, end, source[start:end])
+    text_start = end + 1 # as Linker.apply() cuts out the link text
+    if source[text_start:text_start + 1] == '"':
+      quote = QuoteWrapper(source, text_start)
+      if quote.start is None:
+        return ([], text_start)
+      closing = quote.findClosing()
+      if closing is None:
+        return ([], quote.end) # the unmatched quote
+      self.ctx.nested(source, quote.end, closing[0])
+      return ([], closing[1])
+    hit = self.SPACE_RE.search(source, text_start + 1)
+    if hit:
+      next = hit.start()
+    else:
+      next = len(source)
+    self.ctx.nested(source, text_start, next)
+    return ([], next)
+
+
+class _TagRecorder(object):
+
+  def apply(self):
+    hit = self.hit
+    if hit is None:
+      return ([], self.boundary)
+    tag = hit.group(1)
+    end = hit.end()
+    if tag.endswith("_"):
+      tag = tag[:-1]
+      end -= 1
+    self.ctx.record("hashtag", hit.start(), end, tag)
+    return ([], end)
+
+
+class _MarkerRecorder(object):
+
+  def apply(self):
+    if self.start is None:
+      return ([], self.boundary)
+    closing = self.findClosing()
+    if closing is None:
+      return ([], self.end) # the unmatched marker
+    self.ctx.nested(self.source, self.end, closing[0])
+    return ([], closing[1])
+
+
+_FOUND_RE = re.compile("|".join(proc_class.TRIGGER for proc_class in (Linker, HashTagger, BlockCodeFormatter, InlineCodeFormatter)))
+
+_RECORDERS = ((_PreFormatter, _CodeRecorder), (Linker, _LinkRecorder), (HashTagger, _TagRecorder), (_MarkerBased, _MarkerRecorder))
+
+_PIPELINES = {} # QUEUE -> Pipeline of recording formatters
+
+def _pipeline():
+  "Returns the Pipeline of QUEUE, and the HashTagger, with formatters that record what they find."
+  queue = combinator.QUEUE
+  pipeline = _PIPELINES.get(queue)
+  if pipeline is None:
+    if HashTagger not in queue:
+      queue = list(queue)
+      queue.insert(queue.index(Linker) + 1, HashTagger) # as configure() does
+    recording = []
+    for proc_class in queue:
+      for base, recorder in _RECORDERS:
+        if issubclass(proc_class, base):
+          proc_class = type(proc_class.__name__, (recorder, proc_class), {})
+          break
+      recording.append(proc_class)
+    pipeline = Pipeline(tuple(recording))
+    _PIPELINES[combinator.QUEUE] = pipeline
+  return pipeline
@@ -0,0 +1,107 @@
+# encoding: utf-8
+
+# Copyright 2010 by Dmitry Cheryasov. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are
+# permitted provided that the following conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright notice, this list of
+#       conditions and the following disclaimer.
+#
+#    2. Redistributions in binary form must reproduce the above copyright notice, this list
+#       of conditions and the following disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL COPYRIGHT HOLDER BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# ^^^ This is the "Simplified BSD License"
+
+
+"""
+Fragments produced by formatters.
+
+A formatter emits markup as Tag instances and literal text as plain strings, html-escaped
+like the rest of the source. Both join into HTML as is; plainText() keeps only the text.
+
+If the source is not escaped (see Context.raw), text fragments are escaped after formatting,
+except Escaped ones.
+"""
+
+from cgi import escape as html_escape
+
+__all__ = ["Tag", "Escaped", "plainText", "unescape", "writeFragments"]
+
+CHUNK_SIZE = 1 << 16 # characters that writeFragments() joins before writing
+
+
+class Tag(unicode):
+  """
+  A piece of markup. Its text attribute is what it stands for in plain text, e.g. a newline for <br/>.
+  """
+  __slots__ = ("text",)
+
+  def __new__(cls, markup, text=u""):
+    self = unicode.__new__(cls, markup)
+    self.text = text
+    return self
+
+
+class Escaped(unicode):
+  """
+  Literal text that is html-escaped already.
+  """
+  __slots__ = ()
+
+
+def plainText(frags):
+  "Joins a fragment list into plain text: Tags are replaced by their text, entities are resolved."
+  return unescape(u"".join([frag.text if frag.__class__ is Tag else frag for frag in frags]))
+
+def writeFragments(frags, out, encoding="utf-8", raw=False):
+  """
+  Writes a fragment list to the file-like out, encoded, a chunk at a time; returns the number of bytes written.
+  Neither the joined string nor its encoded copy is held at once. If raw, text fragments are not
+  html-escaped yet (see Context.raw) and get escaped here, a piece at a time.
+  """
+  written = 0
+  chunk = []
+  size = 0
+  for frag in frags:
+    escape = raw and frag.__class__ is not Tag and frag.__class__ is not Escaped
+    if len(frag) > CHUNK_SIZE:
+      # e.g. the text after the last markup of a big document; don't copy it whole
+      pieces = (frag[i:i + CHUNK_SIZE] for i in xrange(0, len(frag), CHUNK_SIZE))
+    else:
+      pieces = (frag,)
+    for piece in pieces:
+      if escape:
+        piece = html_escape(piece)
+      chunk.append(piece)
+      size += len(piece)
+      if size >= CHUNK_SIZE:
+        written += _writeChunk(chunk, out, encoding)
+        chunk = []
+        size = 0
+  if chunk:
+    written += _writeChunk(chunk, out, encoding)
+  return written
+
+def _writeChunk(chunk, out, encoding):
+  data = u"".join(chunk).encode(encoding)
+  out.write(data)
+  return len(data)
+
+def unescape(s):
+  "Undo html_escape()."
+  if "&" in s:
+    s = s.replace("&lt;", "<").replace("&gt;", ">").replace("&quot;", '"').replace("&amp;", "&")
+  return s
@@ -0,0 +1,218 @@
+# encoding: utf-8
+
+# Copyright 2010 by Dmitry Cheryasov. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are
+# permitted provided that the following conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright notice, this list of
+#       conditions and the following disclaimer.
+#
+#    2. Redistributions in binary form must reproduce the above copyright notice, this list
+#       of conditions and the following disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL COPYRIGHT HOLDER BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# ^^^ This is the "Simplified BSD License"
+
+
+"""
+Differential fuzzing of the formatting engine: python -m stelm.fuzz [options]
+
+The reference is the original engine, a frozen copy of it in fuzz_reference: every formatter
+bids in applyQueue() for every piece of the html-escaped source, with no substitution lane,
+no trigger scan and no escaping on emit. It has the default configuration, with hashtags if enabled.
+The engines under test (format() as configured, escape on emit, formatMany(), formatUtf8(),
+the specialized render function) must
+produce exactly the same HTML for generated inputs. A mismatching input is shrunk to a minimal one.
+"""
+
+import sys
+import time
+import random
+import optparse
+
+import combinator
+import specializer
+import fuzz_reference
+from fuzz_reference.hashtagger import HashTagger as ReferenceHashTagger
+
+__all__ = ["INPUT_CLASSES", "ENGINES", "reference", "generate", "shrink", "fuzz", "main"]
+
+
+def reference(s):
+  """
+  format(s) by the original engine, with the default configuration, and the HashTagger if it is
+  in combinator.QUEUE. Swaps fuzz_reference.combinator.QUEUE for that, so not thread-safe.
+  """
+  queue = _REFERENCE_QUEUE
+  if combinator.HashTagger in combinator.QUEUE:
+    queue = list(queue)
+    queue.insert(queue.index(fuzz_reference.combinator.Linker) + 1, ReferenceHashTagger) # as configure() does
+    queue = tuple(queue)
+  saved = fuzz_reference.combinator.QUEUE
+  try:
+    fuzz_reference.combinator.QUEUE = queue
+    return fuzz_reference.format(s)
+  finally:
+    fuzz_reference.combinator.QUEUE = saved
+
+_REFERENCE_QUEUE = fuzz_reference.combinator.QUEUE
+
+def _escapeOnEmit(s):
+  "format(s) with escaping on emit; swaps a module global of combinator, so not thread-safe."
+  saved = combinator.ESCAPE_ON_EMIT
+  try:
+    combinator.ESCAPE_ON_EMIT = True
+    return combinator.format(s)
+  finally:
+    combinator.ESCAPE_ON_EMIT = saved
+
+ENGINES = {
+  "format": combinator.format,
+  "escape_on_emit": _escapeOnEmit,
+  "formatMany": lambda s: combinator.formatMany([s, s])[0],
+  "formatUtf8": lambda s: combinator.formatUtf8(s.encode("utf-8")).decode("utf-8"),
+  "specialized": lambda s: specializer.specialize()(s),
+}
+
+_ATOMS = [u"*", u"_", u"-", u"--", u"---", u"{{", u"}}", u"\\", u"\\*", u"\\}}", u"http://a.b/c", u"|", u'|"', u'"',
+  u" ", u"\n", u"\r\n", u"\n\r", u"\r", u"\t", u"word", u"\u043d\u0435\u0442", u"#tag", u"&", u"<", u">", u"&amp;",
+  u".", u",", u")", u"(", u"!", u"x"]
+_WORDS = [u"a", u"word", u"two words", u"caf\u00e9", u"x&y", u"<i>", u"1", u"\u043d\u0435\u0442"]
+_NEWLINES = [u"\n", u"\r\n", u"\r", u"\n\r"]
+
+def _text(rnd, depth):
+  "Grammar-guided markup: text, possibly wrapping nested markup."
+  kind = rnd.randint(0, depth > 3 and 1 or 9)
+  if kind <= 1:
+    return rnd.choice(_WORDS)
+  if kind <= 4:
+    marker = rnd.choice(u"*_-")
+    inner = _text(rnd, depth + 1)
+    if rnd.random() < 0.2:
+      inner += u"\\" + marker + _text(rnd, depth + 1) # an escaped closing marker inside
+    return u"%s%s%s%s" % (rnd.choice([u"", u" ", u"("]), marker, inner, marker)
+  if kind == 5:
+    return u"\\" + rnd.choice(u"*_-\\{x")
+  if kind == 6:
+    return _link(rnd)
+  if kind == 7:
+    return _code(rnd, depth)
+  if kind == 8:
+    return rnd.choice(_NEWLINES)
+  return u" ".join(_text(rnd, depth + 1) for i in range(rnd.randint(2, 4)))
+
+def _link(rnd):
+  url = u"%s://%s/%s" % (rnd.choice([u"http", u"https", u"ftp", u"mailto", u"zz"]), rnd.choice([u"ex.com", u"a.b"]),
+    rnd.choice([u"", u"p", u"p?q=1&r=2", u"(x)", u"a_b-c*d", u"e;"]))
+  tail = rnd.choice([u"", u"|", u'|"quoted text"', u'|"', u'|"open', u".", u",", u")", u"&amp;"])
+  return rnd.choice([u"", u"*", u"_"]) + url + tail
+
+def _code(rnd, depth):
+  body = u"".join(rnd.choice([u"*a*", u"x < y", u"\\}}", u"_", u"{{", u"\n", u" "]) for i in range(rnd.randint(0, 5)))
+  if rnd.random() < 0.5:
+    newline = rnd.choice(_NEWLINES)
+    return u"{{%s%s%s}}%s" % (newline, body, newline, newline)
+  return u"{{%s}}" % body
+
+def _lines(rnd):
+  return u"".join(rnd.choice([u"---", u"--", u" -- ", u"a", u"  ", u"\t", u"-", u"*b*"]) + rnd.choice(_NEWLINES)
+    for i in range(rnd.randint(1, 6)))
+
+# input class: generator of a document from a random.Random
+INPUT_CLASSES = {
+  "random": lambda rnd: u"".join(rnd.choice(_ATOMS) for i in range(rnd.randint(0, 25))),
+  "nested": lambda rnd: _text(rnd, 0),
+  "links": lambda rnd: u" ".join(_link(rnd) for i in range(rnd.randint(1, 3))),
+  "code": lambda rnd: _text(rnd, 0) + _code(rnd, 0) + _text(rnd, 0),
+  "lines": _lines,
+}
+
+def generate(input_class, count, seed=0):
+  "Returns count documents of an input class, the same for the same seed."
+  rnd = random.Random("%s/%s" % (seed, input_class))
+  make = INPUT_CLASSES[input_class]
+  return [make(rnd) for i in range(count)]
+
+def shrink(s, fails):
+  """
+  Returns a shortest-found substring-wise reduction of s for which fails(s) is still true:
+  removes ever smaller chunks while the failure stays.
+  """
+  chunk = len(s) // 2
+  while chunk >= 1:
+    i = 0
+    while i < len(s):
+      candidate = s[:i] + s[i + chunk:]
+      if fails(candidate):
+        s = candidate
+      else:
+        i += chunk
+    chunk //= 2
+  return s
+
+def fuzz(count=500, seed=0, engines=None, classes=None):
+  """
+  Checks engines ({name: function of a document returning HTML}, ENGINES by default) against reference()
+  on count documents of each input class. Returns (mismatches, timings): mismatches is a list of
+  (input class, engine name, shrunk document); timings maps an input class to
+  {engine name: time relative to the reference}.
+  """
+  engines = engines or ENGINES
+  mismatches = []
+  timings = {}
+  for input_class in sorted(classes or INPUT_CLASSES):
+    docs = generate(input_class, count, seed)
+    started = time.time()
+    expected = [reference(s) for s in docs]
+    reference_time = max(time.time() - started, 1e-9)
+    timings[input_class] = {}
+    for name, engine in sorted(engines.items()):
+      started = time.time()
+      found = [engine(s) for s in docs]
+      timings[input_class][name] = (time.time() - started) / reference_time
+      for s, want, got in zip(docs, expected, found):
+        if want != got:
+          fails = lambda s: _outcome(engine, s) != _outcome(reference, s)
+          mismatches.append((input_class, name, shrink(s, fails)))
+          break # one per engine and input class
+  return (mismatches, timings)
+
+def _outcome(engine, s):
+  try:
+    return engine(s)
+  except Exception, e:
+    return e.__class__
+
+def main(argv=None):
+  "Runs the fuzzer with command-line arguments argv; returns the exit status."
+  parser = optparse.OptionParser(usage="python -m stelm.fuzz [options]",
+    description="Checks engines against the original one on generated inputs.")
+  parser.add_option("-n", "--count", type="int", default=2000, help="documents per input class [%default]")
+  parser.add_option("-s", "--seed", type="int", default=0, help="random seed [%default]")
+  options, args = parser.parse_args(argv)
+  mismatches, timings = fuzz(options.count, options.seed)
+  names = sorted(ENGINES)
+  print "%-8s %s" % ("time", " ".join("%14s" % name for name in names))
+  for input_class, relative in sorted(timings.items()):
+    print "%-8s %s" % (input_class, " ".join("%13.2fx" % relative[name] for name in names))
+  for input_class, name, s in mismatches:
+    print "MISMATCH %s in %s: %r" % (name, input_class, s)
+    print "  reference: %r" % reference(s)
+    print "  %s: %r" % (name, _outcome(ENGINES[name], s))
+  return mismatches and 1 or 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
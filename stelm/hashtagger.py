@@ -26,6 +26,15 @@
 # ^^^ This is the "Simplified BSD License"
 
 import re
+from cgi import escape as html_escape
+
+from batch_resolver import BatchResolver, Deferred, TTLCache
+from fragments import Tag
+from context import DEFAULT_CONTEXT
+
+CLOSE_LINK = Tag(u"</a>")
+
+DEFAULT_TAG_URL = u"/tag/"
 
 class HashTagger(object):
   """
@@ -39,19 +48,51 @@ class HashTagger(object):
   _Italic #foo_ -> foo
   #under_score -> under_score
   #dot.com -> dot.com
+
+  If a resolver is configured, tags are looked up in one batch per document;
+  see configure().
   """
 
   TAG_RE = re.compile(u"#(\w+(?:[\\.]\w+)*)", re.U)
-  TAG_URL = u"/tag/"
+  TRIGGER = "#"
+  BID = ("TAG_RE", 0) # see specializer.py
+  TAG_URL = DEFAULT_TAG_URL
+  RESOLVER = None # a BatchResolver, or None to link every tag as is
 
-  def __init__(self, s, pos):
+  @classmethod
+  def configure(cls, data_dict):
+    """
+    Takes the "hashtags" section:
+    * url: prefix of tag links, "/tag/" by default.
+    * resolver: a function (set of tags) -> {tag: canonical slug}. Tags it leaves out or maps to None
+      (unknown, banned) are rendered as plain text.
+    * cache_size, cache_ttl: bounds of the resolver's answer cache (entries, seconds).
+    A key left out gets its default, and turning hashtags off resets them all.
+    """
+    if "hashtags" not in data_dict:
+      return
+    options = data_dict["hashtags"]
+    if not isinstance(options, dict):
+      options = {}
+    cls.TAG_URL = options.get("url", DEFAULT_TAG_URL)
+    resolver = options.get("resolver", None)
+    if resolver:
+      cache = TTLCache(options.get("cache_size", 10000), options.get("cache_ttl", 300))
+      cls.RESOLVER = BatchResolver(resolver, cache)
+    else:
+      cls.RESOLVER = None
+
+  def __init__(self, s, pos, ctx=DEFAULT_CONTEXT):
     self.source = s
     self.boundary = pos
+    self.ctx = ctx
     hit = self.TAG_RE.search(s, pos)
     self.hit = hit
 
   def getStart(self):
-    return self.hit and self.hit.start() or None
+    if self.hit is None:
+      return None
+    return self.hit.start()
 
   def apply(self):
     source, boundary = self.source, self.boundary
@@ -66,15 +107,21 @@ class HashTagger(object):
         next = self.hit.end()-1
       else:
         next = self.hit.end()
-      res_list.append('<a href="')
-      res_list.append(self.TAG_URL)
-      res_list.append(text)
-      res_list.append('">#')
-      res_list.append(text)
-      res_list.append("</a>")
+      if self.ctx.stats is not None:
+        self.ctx.stats.hashtags += 1
+      if self.RESOLVER is None:
+        res_list.extend(self.renderTag(text, text))
+      else:
+        res_list.append(Deferred(self.RESOLVER, text, lambda slug: self.renderTag(text, slug)))
     else:
       # no start
       next = boundary
       res_list = []
     return (res_list, next)
 
+  def renderTag(self, text, slug):
+    "Fragments for a tag linked to slug, or for a plain-text tag if slug is None."
+    if slug is None:
+      return ["#", text]
+    return [Tag(u'<a href="%s%s">' % (self.TAG_URL, html_escape(slug, True))), u"#", text, CLOSE_LINK]
+
@@ -26,11 +26,80 @@
 # ^^^ This is the "Simplified BSD License"
 
 import re
+import string
 from cgi import escape as html_escape
+from urlparse import urlsplit
 
 from marker_based import _MarkerBased, produce
+from batch_resolver import BatchResolver, Deferred, LRUCache
+from fragments import Tag, Escaped, unescape
+from context import DEFAULT_CONTEXT
+
+CLOSE_LINK = Tag(u"</a>")
+
+LINK_PATTERN = "([a-zA-Z0-9]+://\S+?)(\s|\||$)" # what LinkScanner finds
+
+
+class _LinkMatch(object):
+  "What LinkScanner.search() returns; has the methods of a regex match that are used on it."
+  __slots__ = ("bounds", "string")
+
+  def __init__(self, string, start, end, terminator_end):
+    self.string = string
+    self.bounds = ((start, terminator_end), (start, end), (end, terminator_end))
+
+  def start(self, group=0):
+    return self.bounds[group][0]
+
+  def end(self, group=0):
+    return self.bounds[group][1]
+
+  def group(self, group=0):
+    start, end = self.bounds[group]
+    return self.string[start:end]
+
+  def groups(self):
+    return (self.group(1), self.group(2))
+
+
+class LinkScanner(object):
+  """
+  Finds the same as re.compile(LINK_PATTERN).search(), without the regex engine trying the lazy
+  URL body at every letter: finds the next "://", walks back over the letters and digits of the scheme
+  and forward to the first whitespace or "|" after the first character of the body.
+  Group 1 is the URL, group 2 what ended it: a whitespace, "|" or nothing.
+  """
+  pattern = LINK_PATTERN # for specializer.fingerprint()
+  flags = 0
+
+  SCHEME_CHARS = frozenset(string.ascii_letters + string.digits)
+  SPACE = frozenset(" \t\n\r\f\v") # ASCII whitespace, as \s is without re.U
+  END_RE = re.compile("[\s|]")
+
+  def search(self, s, pos=0, endpos=None):
+    scheme_chars, space = self.SCHEME_CHARS, self.SPACE
+    limit = len(s)
+    if endpos is not None and endpos < limit:
+      limit = endpos # as a regex search with endpos, "$" matches there
+    separator = s.find("://", pos, limit)
+    while separator != -1:
+      start = separator
+      while start > pos and s[start-1] in scheme_chars:
+        start -= 1
+      body = separator + 3
+      if start != separator and body < limit and s[body] not in space:
+        hit = self.END_RE.search(s, body + 1, limit)
+        if hit is None:
+          return _LinkMatch(s, start, limit, limit)
+        end = hit.start()
+        return _LinkMatch(s, start, end, end + 1)
+      separator = s.find("://", separator + 1, limit)
+    return None
+
 
 class _QuoteWrapper(_MarkerBased):
+  STAT = None
+
   def getOpening(self):
     return []
   #
@@ -51,9 +120,13 @@ class Linker(object):
   Strings after vertical bar are further formatted.
   A literal double quote may be included into a quoted string by escaping with a backslash.
   Current limitation: a literal vertical bar cannot be inserted into the URL. Use %7C instead.
+
+  If a link resolver is configured, all URLs of a document are rewritten in one batch; see configure().
   """
 
-  LINK_RE = re.compile("([a-zA-Z0-9]+://\S+?)(\s|\||$)")
+  LINK_RE = LinkScanner()
+  TRIGGER = "://" # what every link contains; see combinator.TRIGGER_RE
+  BID = ("LINK_RE", 0) # see specializer.py
   SPACE_RE = re.compile("\s")
 
   PROTO_CLASS_MAP = { # TODO: move this to options
@@ -65,21 +138,38 @@ class Linker(object):
     '*': 'unknown'
   }
 
+  RESOLVER = None # a BatchResolver, or None to link every URL as is
+
   @classmethod
   def configure(cls, data_dict):
+    """
+    Takes these keys:
+    * protocol_classes: {protocol: CSS class or None}, "*" for any other protocol.
+    * link_resolver: a function (set of URLs) -> {URL: (href, CSS class)}. URLs it leaves out
+      or maps to None stay as they are. A None href drops the link and leaves only its text;
+      a CSS class is added to the protocol class.
+    * link_cache_size: how many resolved URLs to keep, 10000 by default.
+    """
     # TODO: add better config validation; maybe use yaml
     proto_classes = data_dict.get("protocol_classes", None)
     if proto_classes:
       good_types = (str, unicode, (type(None)))
       for k, v in proto_classes.iteritems():
         if not isinstance(v, good_types):
-          print "Bad value %r for key %r" % (r, k)
+          print "Bad value %r for key %r" % (v, k)
           continue
         cls.PROTO_CLASS_MAP[unicode(k)] = v
+    if "link_resolver" in data_dict:
+      resolver = data_dict["link_resolver"]
+      if resolver:
+        cls.RESOLVER = BatchResolver(resolver, LRUCache(data_dict.get("link_cache_size", 10000)))
+      else:
+        cls.RESOLVER = None
 
-  def __init__(self, s, pos):
+  def __init__(self, s, pos, ctx=DEFAULT_CONTEXT):
     self.source = s
     self.boundary = pos
+    self.ctx = ctx
     hit = self.LINK_RE.search(s, pos)
     if hit is None:
       self.start = self.end = None
@@ -91,6 +181,19 @@ class Linker(object):
   def getStart(self):
     return self.start
 
+  @staticmethod
+  def trimUrl(source, start, end):
+    "Returns the end of URL source[start:end] without the trailing pieces that may not belong to it."
+    # last ")" is not a part of URL unless there's an "(" earlier in it; "(" is never trimmed
+    keep_paren = source.find("(", start, end) != -1
+    while True:
+      last_of_url = source[end-1]
+      if last_of_url == ")" and not keep_paren or last_of_url in ".,;:?!\"'":
+        # common punctuation is usually not a part of URL
+        end -= 1
+      else:
+        return end
+
   def apply(self):
     source, boundary, end = self.source, self.boundary, self.end
     if self.start is not None:
@@ -98,24 +201,15 @@ class Linker(object):
       start = self.start
       if boundary != start:
         res_list.append(source[boundary : start])
-      url = source[start : end]
       if not self.has_text:
-        # strip pieces that may not belong to URL
-        while True:
-          last_of_url = url[-1]
-          if last_of_url == ")" and "(" not in url or last_of_url in ".,;:?!\"'":
-            # last ")" is not a part of URL unless there's an "(" earlier in it;
-            # common punctuation is usually not a part of URL
-            end -= 1
-            url = source[start : end]
-          else:
-            break
+        end = self.trimUrl(source, start, end)
+      url = source[start : end]
       if self.has_text:
         after_end = end + 1 # including the space
         # cut out the link text
         maybe_quote = source[after_end : after_end+1]
         if maybe_quote == '"':
-          text_frags, start = QuoteWrapper(source, after_end).apply()
+          text_frags, start = QuoteWrapper(source, after_end, self.ctx).apply()
         else:
           # skip to next space
           hit = self.SPACE_RE.search(source, after_end+1)
@@ -123,28 +217,98 @@ class Linker(object):
             start = hit.start()
           else:
             start = len(source) # had no space till EOL
-          text_frags = applyQueue(source[after_end : start])
+          text_frags = applyQueue(source[after_end : start], self.ctx)
       else:
         text_frags = [url]
         start = end
+      tail = None
+      if self.ctx.raw:
+        # Work with the URL as it looks in escaped source, for the same output.
+        url = html_escape(url)
+        if not self.has_text and url.endswith(";"):
+          # escaped <, > or & at the end loses its ";" like other trailing punctuation
+          url = url[:-1]
+          text_frags = [Escaped(url)]
+          tail = Escaped(u";")
       proto_pos = url.find("://")
       if proto_pos > 0:
         proto = self.PROTO_CLASS_MAP.get(url[:proto_pos], self.PROTO_CLASS_MAP.get("*", None))
       else:
         proto = None
-      if any(bad_char in url for bad_char in '<>"'): # being defensive
-        url = html_escape(url, True)  
-      res_list.extend(('<a href="', url, '"'))
-      if proto:
-        res_list.extend((' class="', proto, '"'))
-      res_list.append('>')
-      res_list.extend(text_frags)
-      res_list.append("</a>")
+      if self.ctx.stats is not None:
+        self.countIn(self.ctx.stats, url)
+      if self.has_text:
+        closing = Tag(u"</a>", u" (%s)" % url) # plain text keeps the URL of a named link
+      else:
+        closing = CLOSE_LINK
+      if self.RESOLVER is not None:
+        key = unescape(url)
+        res_list.append(Deferred(self.RESOLVER, key, lambda answer: self.renderOpening(url, proto, answer)))
+        res_list.extend(text_frags)
+        res_list.append(Deferred(self.RESOLVER, key, lambda answer: self.renderClosing(closing, answer)))
+      else:
+        res_list.extend(self.renderOpening(url, proto, None))
+        res_list.extend(text_frags)
+        res_list.append(closing)
+      if tail is not None:
+        res_list.append(tail)
     else:
       # no start
       start = boundary
       res_list = []
     return (res_list, start)
 
+  def countIn(self, stats, url):
+    stats.links += 1
+    host = urlsplit(unescape(url)).hostname
+    if host:
+      stats.domains[host] = stats.domains.get(host, 0) + 1
+
+  def renderOpening(self, url, proto, answer):
+    "Opening tag for a link; answer is what the resolver said about it, (href, CSS class) or None."
+    if answer is not None:
+      href, css_class = answer
+      if href is None:
+        return [] # blocked, leave only the text
+      url = html_escape(href, True)
+      if css_class:
+        proto = proto and u"%s %s" % (proto, css_class) or css_class
+    elif any(bad_char in url for bad_char in '<>"'): # being defensive
+      url = html_escape(url, True)
+    if proto:
+      return [Tag(u'<a href="%s" class="%s">' % (url, proto))]
+    return [Tag(u'<a href="%s">' % url)]
+
+  def renderClosing(self, closing, answer):
+    if answer is not None and answer[0] is None:
+      return []
+    return [closing]
+
+
+def benchmark(repeat=3):
+  """
+  Returns (seconds with a LINK_PATTERN regex, seconds with LinkScanner) to find and trim all links
+  in a link-heavy text: a reference list, and a log with long ids the regex retries at every letter of.
+  """
+  import time
+  lines = [u"[%d] Author, Title of the work (%d), https://doi.example.org/10.%d/abc(%d). Retrieved from http://ex.com/p?id=%d."
+    % (i, 1990 + i % 30, 1000 + i, i, i) for i in range(300)]
+  lines += [u"2010-01-01 12:00:%02d GET /api/v1/items/%d request=%032x%032x referer=http://example.com/search?q=item%d"
+    % (i % 60, i, i * 7919, i * 104729, i) for i in range(300)]
+  text = u"\n".join(lines)
+  timings = []
+  for finder in (re.compile(LINK_PATTERN), Linker.LINK_RE):
+    best = None
+    for i in range(repeat):
+      started = time.time()
+      hit = finder.search(text)
+      while hit is not None:
+        end = Linker.trimUrl(text, hit.start(), hit.end(1))
+        hit = finder.search(text, end)
+      elapsed = time.time() - started
+      best = best is None and elapsed or min(best, elapsed)
+    timings.append(best)
+  return tuple(timings)
+
 
 from combinator import applyQueue
@@ -33,21 +33,28 @@ Marker-based formatters. Starting sequence is a marker then non-space, ending se
 
 import re
 
+from fragments import Tag
+from context import DEFAULT_CONTEXT
+
 __all__ = ["MarkerBased", "Boldfacer", "Italicizer", "Striker", "produce"]
 
 
 class _MarkerBased(object):
 
+  STAT = "emphasis" # what Stats counts this as
+  BID = ("START_RE", 1) # getStart() is where this group of the leftmost match from pos starts; see specializer.py
+
   @classmethod
   def prepare(cls, **attrs):
     "Patch the class with whatever we want"
     for k,v in attrs.iteritems():
       setattr(cls, k, v)
 
-  def __init__(self, s, pos):
+  def __init__(self, s, pos, ctx=DEFAULT_CONTEXT):
     "Start finding in string s at given pos"
     self.source = s
     self.boundary = pos
+    self.ctx = ctx
     hit = self.START_RE.search(s, pos)
     if hit:
       self.start = hit.start(1)
@@ -59,6 +66,33 @@ class _MarkerBased(object):
     "Returns possible start of formatting position, or None if impossible"
     return self.start
 
+  def findClosing(self):
+    """
+    Returns (start, end) of the marker that closes the one at self.start, not an escaped one;
+    None if there is none.
+    """
+    source = self.source
+    left_limit = self.end
+    while True:
+      hit = self.END_RE.search(source, left_limit)
+      if not hit or hit.start() == self.end:
+        return None
+      escape_mark = hit.group(1)
+      if escape_mark:
+        i = j = hit.start(1)
+        while i >= 0 and source[i] == "\\":
+          i -= 1
+        if (j - i) % 2 == 1: # odd number of \'s ends in a real escape
+          # ignore and repeat
+          left_limit = hit.end(1) + 1
+          continue
+        # ...but not our ending sequence not escaped
+        hit_index = 1
+      else:
+        # just an end marker matched
+        hit_index = 2
+      return (hit.start(hit_index), hit.end(hit_index))
+
   def apply(self):
     "Apply formatter; returns a tuple (list of fragments, next position)."
     source, boundary = self.source, self.boundary
@@ -67,42 +101,20 @@ class _MarkerBased(object):
       res_list = []
       if boundary != start:
         res_list.append(source[boundary:start])
-      left_limit = self.end
-      look_for_closing = True
-      while look_for_closing:
-        look_for_closing = False # usually we need only 1 iteration
-        hit = self.END_RE.search(source, left_limit)
-        if hit and hit.start() != self.end:
-          is_escape = False
-          escape_mark = hit.group(1)
-          if escape_mark:
-            i = j = hit.start(1)
-            while i >= 0 and source[i] == "\\":
-              i -= 1
-            is_escape = (j - i) % 2 == 1 # odd number of \'s ends in a real escape
-            print is_escape 
-          if is_escape:
-            # ignore and repeat
-            left_limit = hit.end(1) + 1
-            look_for_closing = True
-            continue
-          else:
-            if escape_mark:
-              # ...but not our ending sequence not escaped
-              hit_index = 1
-            else:
-              # just an end marker matched
-              hit_index = 2
-            # wrap in tag
-            res_list.extend(self.getOpening())
-            # recursively format the inside of match
-            res_list.extend(applyQueue(source[self.end:hit.start(hit_index)]))
-            res_list.extend(self.getClosing())
-            start = hit.end(hit_index)
-        else:
-          # start but no end
-          res_list.append(source[self.start:self.end]) # the unmatched marker
-          start = self.end
+      closing = self.findClosing()
+      if closing is not None:
+        # wrap in tag
+        res_list.extend(self.getOpening())
+        # recursively format the inside of match
+        res_list.extend(applyQueue(source[self.end:closing[0]], self.ctx))
+        res_list.extend(self.getClosing())
+        start = closing[1]
+        if self.ctx.stats is not None:
+          self.ctx.stats.count(self.STAT)
+      else:
+        # start but no end
+        res_list.append(source[self.start:self.end]) # the unmatched marker
+        start = self.end
     else:
       # no start
       start = boundary
@@ -118,7 +130,7 @@ class _MarkerBased(object):
 
 
 def produce(base_class, marker, tag, start_with_nonword=True):
-  open_tag, close_tag = "<%s>" % tag, "</%s>" % tag
+  open_tag, close_tag = Tag(u"<%s>" % tag), Tag(u"</%s>" % tag)
 
   if start_with_nonword:
     # match nonword + our opening mark
@@ -139,7 +151,8 @@ def produce(base_class, marker, tag, start_with_nonword=True):
       return "%r(%s->%s)@%x" % (self.__class__, marker, tag, id(self))
 
 
-  MarkerWrapper.prepare(START_RE=START_RE, END_RE=END_RE, open_tag=open_tag, close_tag=close_tag)
+  MarkerWrapper.prepare(START_RE=START_RE, END_RE=END_RE, open_tag=open_tag, close_tag=close_tag,
+    TRIGGER=re.escape(marker))
 
   return MarkerWrapper
 
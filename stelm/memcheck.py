@@ -0,0 +1,273 @@
+# encoding: utf-8
+
+# Copyright 2010 by Dmitry Cheryasov. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are
+# permitted provided that the following conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright notice, this list of
+#       conditions and the following disclaimer.
+#
+#    2. Redistributions in binary form must reproduce the above copyright notice, this list
+#       of conditions and the following disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL COPYRIGHT HOLDER BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# ^^^ This is the "Simplified BSD License"
+
+
+"""
+Memory regression checks: python -m stelm.memcheck [--update]
+
+Renders fixed corpora through format() and through each formatter class alone, and measures:
+* fragments_per_kb: fragment strings allocated per KB of input; exact.
+* retained_objects: objects tracked by the garbage collector that are still alive after rendering
+  a corpus for the second time, e.g. in caches or class-level state such as Linker.PROTO_CLASS_MAP.
+* peak_rss_kb: growth of the peak resident size of a fresh process rendering a corpus with format().
+Python 2 has no allocation tracer, so the fragment count stands in for allocation counts,
+and peak RSS for peak traced allocations.
+
+A measurement that exceeds the stored baseline by more than its tolerance is a failure.
+
+python -m stelm.memcheck --fork only reports, for children forked from a parent with and without
+combinator.warmup(), the latency of the first request and the memory each child made private.
+"""
+
+import os
+import gc
+import sys
+import json
+import random
+import optparse
+import subprocess
+
+import combinator
+from combinator import QUEUE, applyQueue, format
+from linker import Linker
+from hashtagger import HashTagger
+
+__all__ = ["CORPORA", "TOLERANCE", "corpus", "measure", "measurePeak", "measureFork", "compare", "main"]
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "memory_baseline.json")
+
+# corpus name: (seed, number of documents, pieces per document, pieces)
+CORPORA = {
+  "chat": (1, 400, 6, [u"ok", u"sure", u" ", u"\n", u"lol", u"*nice*", u"see you", u"--", u"&"]),
+  "article": (2, 60, 300, [u"word ", u"more words. ", u"\n", u"\n\n", u"*bold* ", u"_it_ ", u"-gone- ",
+    u"http://example.com/a ", u'http://x.org|"text" ', u"{{code}} ", u" -- ", u"\\*", u"<&>"]),
+  "code": (3, 40, 30, [u"{{\n", u"}}\n", u"x = 1\n", u"{{inline}} ", u"\\}}", u"*a*\n", u"if a < b:\n"]),
+}
+
+# metric: (allowed relative growth, allowed absolute growth)
+TOLERANCE = {
+  "fragments_per_kb": (0.0, 0.01),
+  "retained_objects": (0.0, 50),
+  "peak_rss_kb": (0.25, 2048),
+}
+
+
+def corpus(name):
+  "Returns the list of documents of a corpus in CORPORA; the same every time."
+  seed, count, length, pieces = CORPORA[name]
+  rnd = random.Random(seed)
+  return [u"".join(rnd.choice(pieces) for i in range(rnd.randint(1, length))) for j in range(count)]
+
+def _engines():
+  "Yields (name, function of a document returning a fragment list) for format() and each formatter alone."
+  yield ("format", combinator.render)
+  names = dict((value, name) for name, value in vars(combinator).items() if value in QUEUE) # produced classes share names
+  for proc_class in QUEUE:
+    yield (names[proc_class], _onlyFormatter(proc_class))
+
+def _onlyFormatter(proc_class):
+  def render(s):
+    saved = combinator.STRUCTURAL, combinator.LANE
+    try:
+      combinator.STRUCTURAL, combinator.LANE = (proc_class,), None
+      return applyQueue(combinator.html_escape(s))
+    finally:
+      combinator.STRUCTURAL, combinator.LANE = saved
+  return render
+
+def _classState():
+  "Size of class-level state that may grow as documents are rendered."
+  size = len(Linker.PROTO_CLASS_MAP)
+  for proc_class in (Linker, HashTagger):
+    if proc_class.RESOLVER is not None:
+      size += len(proc_class.RESOLVER.cache)
+  return size
+
+def measure():
+  "Returns {corpus/engine: {metric: value}} for the metrics measured in this process."
+  results = {}
+  for corpus_name in sorted(CORPORA):
+    docs = corpus(corpus_name)
+    kbytes = sum(len(s) for s in docs) / 1024.0
+    for engine_name, render in _engines():
+      fragments = 0
+      for s in docs: # warm up, e.g. caches fill
+        fragments += len(render(s))
+      gc.collect()
+      before = len(gc.get_objects()) + _classState()
+      for s in docs:
+        render(s)
+      gc.collect()
+      retained = len(gc.get_objects()) + _classState() - before
+      results["%s/%s" % (corpus_name, engine_name)] = {
+        "fragments_per_kb": round(fragments / kbytes, 2),
+        "retained_objects": retained,
+      }
+  return results
+
+def measurePeak():
+  "Returns {corpus/format: {'peak_rss_kb': value}}, each measured in a fresh process."
+  results = {}
+  for corpus_name in sorted(CORPORA):
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--peak", corpus_name],
+      cwd=os.path.dirname(os.path.abspath(__file__)))
+    results["%s/format" % corpus_name] = {"peak_rss_kb": int(output)}
+  return results
+
+def _peak(corpus_name):
+  import resource
+  docs = corpus(corpus_name)
+  format(docs[0])
+  gc.collect()
+  before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  htmls = [format(s) for s in docs] # kept, as a server would until the response is sent
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+
+def measureFork(children=4):
+  """
+  Returns {"cold"|"warm": {metric: value}}, each from a fresh parent that forks children, with
+  combinator.warmup() called before forking for "warm". Metrics are the mean over the children of:
+  * first_request_ms: time to format the first document of the "article" corpus.
+  * second_request_ms: time to format it again, for comparison.
+  * private_kb: memory a child made private, i.e. copied on write, after formatting the whole corpus;
+    None where /proc/self/smaps is missing.
+  """
+  results = {}
+  for mode in ("cold", "warm"):
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--fork-child", mode,
+      "--children", str(children)], cwd=os.path.dirname(os.path.abspath(__file__)))
+    results[mode] = json.loads(output)
+  return results
+
+def _privateKb():
+  "Private_Dirty of this process in KB, or None where /proc/self/smaps is missing."
+  try:
+    f = open("/proc/self/smaps")
+  except IOError:
+    return None
+  try:
+    return sum(int(line.split()[1]) for line in f if line.startswith("Private_Dirty:"))
+  finally:
+    f.close()
+
+def _forkChildren(mode, children):
+  import time
+  docs = corpus("article")
+  if mode == "warm":
+    combinator.warmup()
+  gc.collect()
+  measurements = []
+  for i in range(children):
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+      os.close(read_end)
+      started = time.time()
+      format(docs[0])
+      first = (time.time() - started) * 1000
+      started = time.time()
+      format(docs[0])
+      again = (time.time() - started) * 1000
+      for s in docs:
+        format(s)
+      os.write(write_end, json.dumps([first, again, _privateKb()]))
+      os._exit(0)
+    os.close(write_end)
+    data = ""
+    while True:
+      part = os.read(read_end, 4096)
+      if not part:
+        break
+      data += part
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    measurements.append(json.loads(data))
+  first = sum(m[0] for m in measurements) / len(measurements)
+  again = sum(m[1] for m in measurements) / len(measurements)
+  private = [m[2] for m in measurements if m[2] is not None]
+  return {"first_request_ms": round(first, 3), "second_request_ms": round(again, 3),
+    "private_kb": private and sum(private) / len(private) or None}
+
+def compare(results, baseline):
+  "Returns a list of messages for measurements that exceed baseline, or have no baseline."
+  failures = []
+  for key in sorted(results):
+    for metric, value in sorted(results[key].items()):
+      if metric not in baseline.get(key, {}):
+        failures.append("%s %s: %s, no baseline" % (key, metric, value))
+        continue
+      allowed = baseline[key][metric]
+      relative, absolute = TOLERANCE[metric]
+      if value > allowed * (1 + relative) + absolute:
+        failures.append("%s %s: %s, baseline %s" % (key, metric, value, allowed))
+  return failures
+
+def loadBaseline(path=BASELINE_FILE):
+  f = open(path)
+  try:
+    return json.load(f)
+  finally:
+    f.close()
+
+def main(argv=None):
+  "Runs the checks with command-line arguments argv; returns the exit status."
+  parser = optparse.OptionParser(usage="python -m stelm.memcheck [options]",
+    description="Checks memory use of the formatting engine against stored baselines.")
+  parser.add_option("--update", action="store_true", help="store the measurements as the new baseline")
+  parser.add_option("--fork", action="store_true", help="only report first-request latency and memory of forked children")
+  parser.add_option("--children", type="int", default=4, help="children to fork for --fork [%default]")
+  parser.add_option("--peak", metavar="CORPUS", help=optparse.SUPPRESS_HELP)
+  parser.add_option("--fork-child", metavar="MODE", help=optparse.SUPPRESS_HELP)
+  options, args = parser.parse_args(argv)
+  if options.peak:
+    print _peak(options.peak)
+    return 0
+  if options.fork_child:
+    print json.dumps(_forkChildren(options.fork_child, options.children))
+    return 0
+  if options.fork:
+    for mode, metrics in sorted(measureFork(options.children).items()):
+      print "%s: %s" % (mode, ", ".join("%s=%s" % item for item in sorted(metrics.items())))
+    return 0
+  results = measure()
+  for key, metrics in measurePeak().items():
+    results.setdefault(key, {}).update(metrics)
+  if options.update:
+    f = open(BASELINE_FILE, "w")
+    try:
+      json.dump(results, f, indent=1, sort_keys=True)
+    finally:
+      f.close()
+    return 0
+  failures = compare(results, loadBaseline())
+  for message in failures:
+    sys.stderr.write("stelm.memcheck: %s\n" % message)
+  return failures and 1 or 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,230 @@
+# encoding: utf-8
+
+# Copyright 2010 by Dmitry Cheryasov. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are
+# permitted provided that the following conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright notice, this list of
+#       conditions and the following disclaimer.
+#
+#    2. Redistributions in binary form must reproduce the above copyright notice, this list
+#       of conditions and the following disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL COPYRIGHT HOLDER BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# ^^^ This is the "Simplified BSD License"
+
+
+"""
+Formatting off the caller's thread, for event-loop based services.
+
+Offloader.submit() returns a RenderFuture. Documents found in the render cache and documents
+shorter than a threshold are formatted at once, in the calling thread; longer ones go to worker
+threads or processes. At most max_pending offloaded documents may be queued or running;
+beyond that submit() blocks, or raises Queue.Full if asked not to block.
+
+An event loop would hand a completion to itself from the future's callback, e.g. with
+loop.call_soon_threadsafe() or by writing to a wake-up pipe; the callback runs in a worker thread.
+"""
+
+import threading
+from Queue import Queue, Full
+
+from combinator import initWorker, format, formatMany
+from batch_resolver import LRUCache
+
+__all__ = ["Offloader", "RenderFuture", "RenderTimeout"]
+
+_MISSING = object() # not in the render cache
+
+
+class RenderTimeout(Exception):
+  "RenderFuture.result() waited longer than asked."
+
+
+class RenderFuture(object):
+  """
+  The HTML of a submitted document, once done.
+  """
+
+  def __init__(self):
+    self.event = threading.Event()
+    self.lock = threading.Lock()
+    self.html = self.error = None
+    self.callbacks = []
+
+  def done(self):
+    return self.event.is_set()
+
+  def result(self, timeout=None):
+    "Waits for the HTML and returns it; raises what formatting raised, or RenderTimeout."
+    if not self.event.wait(timeout):
+      raise RenderTimeout()
+    if self.error is not None:
+      raise self.error
+    return self.html
+
+  def addDoneCallback(self, fn):
+    "Calls fn(future) when done, in the thread that finishes it; at once if done already."
+    with self.lock:
+      if not self.event.is_set():
+        self.callbacks.append(fn)
+        return
+    fn(self)
+
+  def finish(self, html, error=None):
+    with self.lock:
+      self.html, self.error = html, error
+      self.event.set()
+      callbacks, self.callbacks = self.callbacks, []
+    for fn in callbacks:
+      fn(self)
+
+
+def _formatSafely(s):
+  # a failing apply_async() job never calls back in Python 2; report the error as the result instead
+  try:
+    return (format(s), None)
+  except Exception, e:
+    return (None, e)
+
+
+class Offloader(object):
+  """
+  Formats documents of threshold characters or longer in workers; see the module docstring.
+  * workers: number of threads, or of processes if processes is true.
+  * config: the dict the processes pass to configure(); threads share the caller's configuration.
+  * cache_size: entries in the render cache, 0 for none. Call clearCache() after configure().
+  """
+
+  def __init__(self, workers=2, threshold=2048, max_pending=64, cache_size=1024, processes=False, config=None):
+    self.threshold = threshold
+    self.max_pending = max_pending
+    self.cache = None
+    if cache_size:
+      self.cache = LRUCache(cache_size)
+    self.slots = threading.BoundedSemaphore(max_pending)
+    self.pool = self.jobs = None
+    if processes:
+      import multiprocessing
+      self.pool = multiprocessing.Pool(workers, initWorker, (config,))
+    else:
+      self.jobs = Queue()
+      self.threads = [threading.Thread(target=self.work, name="stelm-offload-%d" % i) for i in range(workers)]
+      for thread in self.threads:
+        thread.daemon = True
+        thread.start()
+
+  def submit(self, s, callback=None, block=True):
+    """
+    Returns a RenderFuture for format(s); callback(future) is called when it is done.
+    Blocks while max_pending documents are offloaded already; with block false, raises Queue.Full instead.
+    """
+    future = RenderFuture()
+    if callback is not None:
+      future.addDoneCallback(callback)
+    html = _MISSING
+    if self.cache is not None:
+      html = self.cache.get(s, _MISSING)
+    if html is not _MISSING:
+      future.finish(html)
+    elif len(s) < self.threshold:
+      self.finish(future, s, _formatSafely(s))
+    else:
+      if not self.slots.acquire(block):
+        raise Full()
+      if self.pool is not None:
+        self.pool.apply_async(_formatSafely, (s,), callback=lambda outcome: self.release(future, s, outcome))
+      else:
+        self.jobs.put((future, s))
+    return future
+
+  def submitMany(self, docs, callback=None, block=True):
+    """
+    Returns a list of RenderFutures for docs, like submit() for each, but the short documents
+    that are not in the cache are formatted together with formatMany(); the rest go through submit().
+    """
+    cache = self.cache
+    futures = []
+    short = [] # (future, document) to finish from formatMany()
+    for s in docs:
+      if len(s) < self.threshold and (cache is None or cache.get(s, _MISSING) is _MISSING):
+        future = RenderFuture()
+        if callback is not None:
+          future.addDoneCallback(callback)
+        short.append((future, s))
+        futures.append(future)
+      else:
+        futures.append(self.submit(s, callback, block))
+    if short:
+      try:
+        outcomes = [(html, None) for html in formatMany([s for future, s in short])]
+      except Exception:
+        outcomes = [_formatSafely(s) for future, s in short] # the error goes to its own document
+      for (future, s), outcome in zip(short, outcomes):
+        self.finish(future, s, outcome)
+    return futures
+
+  def imap(self, docs, ahead=None):
+    """
+    Yields format(s) for docs in order, keeping up to ahead documents (max_pending by default) submitted
+    before the one being waited for.
+    """
+    ahead = ahead or self.max_pending
+    pending = []
+    for s in docs:
+      pending.append(self.submit(s))
+      if len(pending) > ahead:
+        yield pending.pop(0).result()
+    for future in pending:
+      yield future.result()
+
+  def work(self):
+    while True:
+      job = self.jobs.get()
+      if job is None:
+        return
+      future, s = job
+      self.release(future, s, _formatSafely(s))
+
+  def release(self, future, s, outcome):
+    self.slots.release()
+    self.finish(future, s, outcome)
+
+  def finish(self, future, s, outcome):
+    html, error = outcome
+    if error is None and self.cache is not None:
+      self.cache.put(s, html)
+    future.finish(html, error)
+
+  def clearCache(self):
+    if self.cache is not None:
+      self.cache.clear()
+
+  def close(self):
+    "Finishes offloaded documents and stops the workers."
+    if self.pool is not None:
+      self.pool.close()
+      self.pool.join()
+    else:
+      for thread in self.threads:
+        self.jobs.put(None)
+      for thread in self.threads:
+        thread.join()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
@@ -26,6 +26,58 @@
 # ^^^ This is the "Simplified BSD License"
 
 import re
+from cgi import escape as html_escape
+from threading import Lock
+
+from fragments import Tag, unescape
+from context import DEFAULT_CONTEXT
+from batch_resolver import Deferred, LRUCache
+
+
+class CodeHook(object):
+  """
+  Runs a hook fn(text, kind) -> HTML on the raw text of code blocks, caching results by text and kind.
+  With a pool (a multiprocessing Pool or ThreadPool), a block is handed to it as soon as it is found
+  and processed while the rest of the document is formatted; resolve() collects the results.
+  Used as a resolver of Deferred fragments.
+  """
+
+  def __init__(self, fn, cache, pool=None):
+    self.fn = fn
+    self.cache = cache
+    self.pool = pool
+    self.pending = {} # key -> AsyncResult
+    self.lock = Lock()
+
+  def start(self, key):
+    "Start processing key = (text, kind) in the pool, if there is one."
+    if self.pool is None or self.cache.get(key) is not None:
+      return
+    with self.lock:
+      if key not in self.pending:
+        self.pending[key] = self.pool.apply_async(self.fn, key)
+
+  def resolve(self, keys):
+    answers = {}
+    for key in keys:
+      html = self.cache.get(key)
+      if html is None:
+        with self.lock:
+          job = self.pending.get(key)
+        if job is None:
+          html = self.fn(*key)
+        else:
+          html = job.get()
+        self.cache.put(key, html)
+        with self.lock:
+          self.pending.pop(key, None)
+      answers[key] = html
+    return answers
+
+  def close(self):
+    if self.pool is not None:
+      self.pool.close()
+
 
 class _PreFormatter(object):
   """
@@ -37,6 +89,10 @@ class _PreFormatter(object):
   Since this formatter prints what other formatters might interpret, it must come first in the queue.
   """
 
+  BID = ("START_RE", 0) # see specializer.py
+  OPAQUE = True # others need not look inside; see combinator.applySegmented()
+  RESOLVER = None # a CodeHook, or None to put code as is
+
   @classmethod
   def prepare(cls, **attrs):
     "Patch the class with whatever we want"
@@ -44,9 +100,46 @@ class _PreFormatter(object):
       setattr(cls, k, v)
     return cls
 
-  def __init__(self, s, pos):
+  @classmethod
+  def configure(cls, data_dict):
+    """
+    Takes these keys, for both kinds of code:
+    * code_hook: a function (text, kind) -> HTML to put between the code tags instead of the text,
+      e.g. a syntax highlighter. text is the raw code, kind is "block" or "inline". None turns it off.
+    * code_cache_size: how many results to keep, 1000 by default.
+    * code_workers: size of a pool to run the hook in while the rest of a document is formatted,
+      0 (default) to run it when the document is done.
+    * code_processes: if true, the pool is of processes, and the hook must be a module-level function.
+    Configuring the same hook again keeps its cache.
+    """
+    if "code_hook" not in data_dict:
+      return
+    fn = data_dict["code_hook"]
+    options = (fn, data_dict.get("code_cache_size", 1000), data_dict.get("code_workers", 0), data_dict.get("code_processes", False))
+    hook = _PreFormatter.RESOLVER
+    if hook is not None:
+      if hook.options == options:
+        return # called for every code formatter class
+      hook.close()
+    if fn:
+      fn, cache_size, workers, processes = options
+      pool = None
+      if workers:
+        if processes:
+          from multiprocessing import Pool
+        else:
+          from multiprocessing.pool import ThreadPool as Pool
+        pool = Pool(workers)
+      hook = CodeHook(fn, LRUCache(cache_size), pool)
+      hook.options = options
+      _PreFormatter.RESOLVER = hook
+    else:
+      _PreFormatter.RESOLVER = None
+
+  def __init__(self, s, pos, ctx=DEFAULT_CONTEXT):
     self.source = s
     self.boundary = pos
+    self.ctx = ctx
     hit = self.START_RE.search(s, pos)
     if hit is None:
       self.start = self.end = None
@@ -57,38 +150,54 @@ class _PreFormatter(object):
   def getStart(self):
     return self.start
 
+  @classmethod
+  def findBody(cls, source, pos):
+    """
+    Look for the end of a block whose content starts at pos.
+    Returns (escaped pieces of content, closing match or None, position after the last escape).
+    The rest of the content is source[position after the last escape : closing match start].
+    """
+    innards = []
+    while True:
+      hit = cls.END_RE.search(source, pos)
+      if hit and hit.groups()[0] == cls.ESCAPED:
+        # cut out and continue
+        innards.append(source[pos:hit.start()])
+        innards.append(cls.END_SEQ)
+        pos = hit.end()
+      else:
+        return (innards, hit, pos)
+
   def apply(self):
     source, boundary = self.source, self.boundary
     if self.start is not None:
       res_list = []
-      innards = []
       start = self.start
       if boundary != start:
         res_list.append(source[boundary:start])
-      left_limit = self.end
-      look_for_closing = True
-      while look_for_closing:
-        look_for_closing = False # usually we need only 1 iteration
-        hit = self.END_RE.search(source, left_limit)
-        if hit:
-          mark = hit.groups()[0]
-          if mark == self.ESCAPED:
-            # cut out and continue
-            innards.append(source[self.end:hit.start()])
-            innards.append(self.END_SEQ)
-            self.end = left_limit = hit.end()
-            look_for_closing = True
-          else:
-            # wrap in tag
-            res_list.append(self.open_tag)
-            res_list.extend(innards)
-            res_list.append(source[self.end:hit.start()])
-            res_list.append(self.close_tag)
-            start = hit.end()
+      innards, hit, self.end = self.findBody(source, self.end)
+      if hit:
+        # wrap in tag
+        res_list.append(self.open_tag)
+        if self.RESOLVER is None:
+          res_list.extend(innards)
+          res_list.append(source[self.end:hit.start()])
         else:
-          # start but no end
-          res_list.append(source[self.start:self.end]) # the unmatched marker
-          start = self.end
+          text = u"".join(innards) + source[self.end:hit.start()]
+          if not self.ctx.raw:
+            text = unescape(text)
+          key = (text, self.KIND)
+          self.RESOLVER.start(key)
+          # the hook's HTML is markup; in plain text the code stays as it was
+          res_list.append(Deferred(self.RESOLVER, key, lambda html: [Tag(html, html_escape(text))]))
+        res_list.append(self.close_tag)
+        start = hit.end()
+        if self.ctx.stats is not None:
+          self.ctx.stats.count(self.STAT)
+      else:
+        # start but no end
+        res_list.append(source[self.start:self.end]) # the unmatched marker
+        start = self.end
     else:
       # no start
       start = boundary
@@ -98,7 +207,7 @@ class _PreFormatter(object):
 
 
 def _produceCodeBlockFromatter(start_seq, end_seq, tag_name):
-  open_tag, close_tag = "<%s>" % tag_name, "</%s>" % tag_name
+  open_tag, close_tag = Tag(u"<%s>" % tag_name, u"\n"), Tag(u"</%s>" % tag_name, u"\n")
 
   START = ur"\n?\s*" + start_seq + "\s*\n"
   END = ur"\n\s*" + end_seq + "\s*\n?"
@@ -113,11 +222,11 @@ def _produceCodeBlockFromatter(start_seq, end_seq, tag_name):
 
   return CodeBlockWrapper.prepare(
     START_RE = START_RE, END_RE=END_RE, ESCAPED=ESCAPED, END_SEQ=end_seq,
-    open_tag=open_tag, close_tag=close_tag
+    open_tag=open_tag, close_tag=close_tag, STAT="code_blocks", KIND="block", TRIGGER=re.escape(start_seq)
   )
 
 def _produceInlineCodeFormatter(start_seq, end_seq, tag_name):
-  open_tag, close_tag = "<%s>" % tag_name, "</%s>" % tag_name
+  open_tag, close_tag = Tag(u"<%s>" % tag_name), Tag(u"</%s>" % tag_name)
 
   START = start_seq
   END = end_seq
@@ -132,7 +241,7 @@ def _produceInlineCodeFormatter(start_seq, end_seq, tag_name):
 
   return InlineBlockWrapper.prepare(
     START_RE = START_RE, END_RE=END_RE, ESCAPED=ESCAPED, END_SEQ=end_seq,
-    open_tag=open_tag, close_tag=close_tag
+    open_tag=open_tag, close_tag=close_tag, STAT="inline_code", KIND="inline", TRIGGER=re.escape(start_seq)
   )
 
 
@@ -0,0 +1,197 @@
+# encoding: utf-8
+
+# Copyright 2010 by Dmitry Cheryasov. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are
+# permitted provided that the following conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright notice, this list of
+#       conditions and the following disclaimer.
+#
+#    2. Redistributions in binary form must reproduce the above copyright notice, this list
+#       of conditions and the following disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL COPYRIGHT HOLDER BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# ^^^ This is the "Simplified BSD License"
+
+
+"""
+Resumable re-render of documents stored in a SQLite database:
+python -m stelm.rerender [options] database table
+
+Reads the source column of every row in order of the id column, formats rows in batches
+over a pool of worker processes, and writes the HTML column back, a transaction per batch.
+Each transaction also records the last id done in the stelm_checkpoint table, so a stopped job
+resumes where it stopped; a job that runs to the end removes its checkpoint, so the next run
+goes over all rows again. With a hash column, a row whose source and formatter configuration
+are unchanged since it was last rendered is skipped.
+"""
+
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+import optparse
+from collections import deque
+
+from combinator import initWorker, loadConfig, formatMany
+
+__all__ = ["rerender", "configFingerprint", "main"]
+
+CHECKPOINT_TABLE = "stelm_checkpoint"
+
+
+def configFingerprint(config):
+  "Returns a string that changes whenever the configuration dict passed to configure() does."
+  return hashlib.sha1(json.dumps(config or {}, sort_keys=True)).hexdigest()
+
+def _quote(name):
+  return '"%s"' % name.replace('"', '""')
+
+def _sourceHash(fingerprint, source):
+  return hashlib.sha1(fingerprint + "\0" + source.encode("utf-8")).hexdigest()
+
+def _renderBatch(batch):
+  "[(id, source, hash or None)] -> [(id, html, hash)] for rows that need it, and the number skipped."
+  fingerprint, rows = batch
+  todo = []
+  for row_id, source, old_hash in rows:
+    if isinstance(source, buffer):
+      source = str(source).decode("utf-8")
+    elif source is None:
+      source = u""
+    new_hash = _sourceHash(fingerprint, source)
+    if new_hash != old_hash:
+      todo.append((row_id, source, new_hash))
+  htmls = formatMany([source for row_id, source, new_hash in todo])
+  return ([(row_id, html, new_hash) for (row_id, source, new_hash), html in zip(todo, htmls)], len(rows) - len(todo))
+
+def rerender(path, table, id_column, source_column, html_column, hash_column=None, config=None,
+             batch_size=500, jobs=1, restart=False, report=None):
+  """
+  Re-renders table in the SQLite database at path; see the module docstring.
+  config is the dict to pass to configure() in the workers; it should be what the current process
+  is configured with, too. A job is identified by table and columns; restart ignores its checkpoint.
+  report(rows, rendered, skipped, seconds), if given, is called after each batch.
+  Returns (rows, rendered, skipped).
+  """
+  fingerprint = configFingerprint(config)
+  job = "%s.%s->%s" % (table, source_column, html_column)
+  db = sqlite3.connect(path)
+  try:
+    db.execute("CREATE TABLE IF NOT EXISTS %s (job TEXT PRIMARY KEY, last_id, fingerprint TEXT)" % CHECKPOINT_TABLE)
+    last_id = None
+    if not restart:
+      saved = db.execute("SELECT last_id, fingerprint FROM %s WHERE job = ?" % CHECKPOINT_TABLE, (job,)).fetchone()
+      if saved is not None and saved[1] == fingerprint:
+        last_id = saved[0] # else the configuration changed, and it's a new job
+    select = "SELECT %s, %s, %s FROM %s WHERE %%s ORDER BY %s LIMIT %d" % (
+      _quote(id_column), _quote(source_column), hash_column and _quote(hash_column) or "NULL",
+      _quote(table), _quote(id_column), batch_size)
+    if hash_column:
+      update = "UPDATE %s SET %s = ?, %s = ? WHERE %s = ?" % (
+        _quote(table), _quote(html_column), _quote(hash_column), _quote(id_column))
+    else:
+      update = "UPDATE %s SET %s = ? WHERE %s = ?" % (_quote(table), _quote(html_column), _quote(id_column))
+
+    def batches(last_id):
+      while True:
+        if last_id is None:
+          rows = db.execute(select % "1").fetchall()
+        else:
+          rows = db.execute(select % ("%s > ?" % _quote(id_column)), (last_id,)).fetchall()
+        if not rows:
+          return
+        last_id = rows[-1][0]
+        yield (last_id, rows)
+
+    counts = [0, 0, 0] # rows, rendered, skipped
+    started = time.time()
+
+    def store(last_id, size, result):
+      done, skipped = result
+      with db: # one transaction
+        if hash_column:
+          db.executemany(update, [(html, new_hash, row_id) for row_id, html, new_hash in done])
+        else:
+          db.executemany(update, [(html, row_id) for row_id, html, new_hash in done])
+        db.execute("INSERT OR REPLACE INTO %s VALUES (?, ?, ?)" % CHECKPOINT_TABLE, (job, last_id, fingerprint))
+      counts[0] += size
+      counts[1] += len(done)
+      counts[2] += skipped
+      if report is not None:
+        report(counts[0], counts[1], counts[2], time.time() - started)
+
+    if jobs > 1:
+      import multiprocessing
+      pool = multiprocessing.Pool(jobs, initWorker, (config,))
+      try:
+        pending = deque() # at most 2 batches per worker are read ahead
+        for last_id, rows in batches(last_id):
+          pending.append((last_id, len(rows), pool.apply_async(_renderBatch, ((fingerprint, rows),))))
+          if len(pending) >= 2 * jobs:
+            last_id, size, result = pending.popleft()
+            store(last_id, size, result.get())
+        while pending:
+          last_id, size, result = pending.popleft()
+          store(last_id, size, result.get())
+      finally:
+        pool.terminate()
+        pool.join()
+    else:
+      for last_id, rows in batches(last_id):
+        store(last_id, len(rows), _renderBatch((fingerprint, rows)))
+    with db: # done; the next run starts over, and skips what has not changed
+      db.execute("DELETE FROM %s WHERE job = ?" % CHECKPOINT_TABLE, (job,))
+    return tuple(counts)
+  finally:
+    db.close()
+
+def _report(rows, rendered, skipped, seconds):
+  sys.stderr.write("\r%d rows, %d rendered, %d skipped, %.0f rows/s " % (rows, rendered, skipped, rows / max(seconds, 1e-6)))
+
+def main(argv=None):
+  "Runs the job with command-line arguments argv; returns the exit status."
+  parser = optparse.OptionParser(usage="python -m stelm.rerender [options] database table",
+    description=__doc__.split("\n\n")[1].replace("\n", " "))
+  parser.add_option("--id", default="id", help="id column, unique and ordered [%default]")
+  parser.add_option("--source", default="source", help="source text column [%default]")
+  parser.add_option("--html", default="html", help="column to write HTML to [%default]")
+  parser.add_option("--hash", help="column keeping the hash of source and configuration; enables skipping")
+  parser.add_option("-b", "--batch", type="int", default=500, help="rows per batch and transaction [%default]")
+  parser.add_option("-j", "--jobs", type="int", default=0, help="number of worker processes [number of CPUs]")
+  parser.add_option("-c", "--config", metavar="FILE", help="JSON file to pass to combinator.configure()")
+  parser.add_option("--restart", action="store_true", help="ignore the saved checkpoint")
+  parser.add_option("-q", "--quiet", action="store_true", help="print no progress")
+  options, args = parser.parse_args(argv)
+  if len(args) != 2:
+    parser.error("need a database and a table")
+  config = loadConfig(options.config)
+  initWorker(config)
+  jobs = options.jobs
+  if not jobs:
+    import multiprocessing
+    jobs = multiprocessing.cpu_count()
+  started = time.time()
+  rows, rendered, skipped = rerender(args[0], args[1], options.id, options.source, options.html, options.hash,
+    config, options.batch, jobs, options.restart, not options.quiet and _report or None)
+  if not options.quiet:
+    _report(rows, rendered, skipped, time.time() - started)
+    sys.stderr.write("\n")
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
@@ -0,0 +1,271 @@
+# encoding: utf-8
+
+# Copyright 2010 by Dmitry Cheryasov. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are
+# permitted provided that the following conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright notice, this list of
+#       conditions and the following disclaimer.
+#
+#    2. Redistributions in binary form must reproduce the above copyright notice, this list
+#       of conditions and the following disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL COPYRIGHT HOLDER BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# ^^^ This is the "Simplified BSD License"
+
+
+"""
+Render server on a Unix domain socket: python -m stelm.server [options] socket_path
+
+Keeps formatters configured and a render cache warm, so that clients don't pay for starting
+Python and importing stelm. Documents are formatted in a pool of worker processes; a worker
+that takes longer than the time limit on a request is killed and replaced.
+
+Protocol: every message is a 4-byte big-endian length followed by that many bytes of UTF-8 JSON.
+A request is {"id": anything, "docs": [string, ...]}; the response is {"id": the same, "html": [string, ...]},
+or {"id": the same, "error": message}. A connection stays open for any number of requests, and a client
+may send several before reading responses; they are answered in order. Responses are written while
+requests are read, so a client that sends ahead must read responses at the same time. See client.py.
+"""
+
+import os
+import sys
+import json
+import time
+import errno
+import signal
+import struct
+import optparse
+import threading
+import SocketServer
+from Queue import Queue
+from multiprocessing import Process, Pipe
+
+from combinator import initWorker, loadConfig, formatMany, warmup
+from batch_resolver import LRUCache
+
+__all__ = ["RenderServer", "WorkerPool", "readMessage", "encodeMessage", "writeMessage", "main"]
+
+HEADER = struct.Struct(">I")
+MAX_MESSAGE = 64 << 20 # bytes
+
+_MISSING = object() # not in the render cache
+
+
+def readMessage(stream):
+  "Reads one message from a file-like stream; returns the decoded JSON, or None at end of stream."
+  header = stream.read(HEADER.size)
+  if len(header) < HEADER.size:
+    return None
+  size, = HEADER.unpack(header)
+  if size > MAX_MESSAGE:
+    raise ValueError("message of %d bytes is too long" % size)
+  data = stream.read(size)
+  if len(data) < size:
+    return None
+  return json.loads(data.decode("utf-8"))
+
+def encodeMessage(message):
+  "Returns the bytes of a message, header included."
+  data = json.dumps(message).encode("utf-8")
+  return HEADER.pack(len(data)) + data
+
+def writeMessage(stream, message):
+  stream.write(encodeMessage(message))
+
+
+def _renderDocs(docs):
+  return formatMany(docs)
+
+def _serveWorker(conn, config):
+  "Body of a worker process: formats lists of documents received from conn."
+  signal.signal(signal.SIGINT, signal.SIG_IGN) # the server process handles it
+  initWorker(config)
+  while True:
+    try:
+      docs = conn.recv()
+    except EOFError:
+      return
+    try:
+      conn.send((_renderDocs(docs), None))
+    except Exception, e:
+      conn.send((None, "%s: %s" % (e.__class__.__name__, e)))
+
+
+class _Worker(object):
+
+  def __init__(self, config):
+    self.conn, child_conn = Pipe()
+    self.process = Process(target=_serveWorker, args=(child_conn, config))
+    self.process.daemon = True
+    self.process.start()
+    child_conn.close()
+
+  def kill(self):
+    self.process.terminate()
+    self.process.join()
+    self.conn.close()
+
+
+class WorkerPool(object):
+  """
+  Worker processes, each formatting one request at a time.
+  A worker that doesn't answer within time_limit seconds is killed and replaced.
+  """
+
+  def __init__(self, workers=2, time_limit=5.0, config=None):
+    self.time_limit = time_limit
+    self.config = config
+    self.idle = Queue()
+    self.workers = []
+    self.replaced = 0 # workers killed for running over time, or for dying
+    for i in range(workers):
+      self.idle.put(self.startWorker())
+
+  def startWorker(self):
+    worker = _Worker(self.config)
+    self.workers.append(worker)
+    return worker
+
+  def render(self, docs):
+    "Returns (list of html, None) for docs, or (None, error message)."
+    worker = self.idle.get()
+    try:
+      worker.conn.send(docs)
+      if worker.conn.poll(self.time_limit):
+        result = worker.conn.recv()
+        self.idle.put(worker)
+        worker = None
+        return result
+      error = "time limit of %gs exceeded" % self.time_limit
+    except (EOFError, IOError), e:
+      error = "worker failed: %s" % e
+    finally:
+      if worker is not None:
+        # stuck or dead; whatever it was doing is lost
+        self.workers.remove(worker)
+        worker.kill()
+        self.replaced += 1
+        self.idle.put(self.startWorker())
+    return (None, error)
+
+  def close(self):
+    for worker in list(self.workers):
+      worker.kill()
+    self.workers = []
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+
+  def handle(self):
+    server = self.server
+    while True:
+      try:
+        request = readMessage(self.rfile)
+      except ValueError, e:
+        writeMessage(self.wfile, {"id": None, "error": str(e)})
+        return
+      if request is None:
+        return
+      writeMessage(self.wfile, server.answer(request))
+      self.wfile.flush()
+
+
+class RenderServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  """
+  Answers requests from connections, each in a thread of its own, by formatting in a WorkerPool.
+  Results are kept in a cache of cache_size documents.
+  """
+  daemon_threads = True
+
+  def __init__(self, path, pool, cache_size=10000):
+    SocketServer.UnixStreamServer.__init__(self, path, _RequestHandler)
+    self.pool = pool
+    self.cache = None
+    if cache_size:
+      self.cache = LRUCache(cache_size)
+    self.requests = self.documents = 0
+
+  def answer(self, request):
+    "Returns the response message to a request message."
+    request_id = request.get("id") if isinstance(request, dict) else None
+    docs = isinstance(request, dict) and request.get("docs")
+    if not isinstance(docs, list) or not all(isinstance(s, basestring) for s in docs):
+      return {"id": request_id, "error": "docs must be a list of strings"}
+    self.requests += 1
+    self.documents += len(docs)
+    cache = self.cache
+    if cache is None:
+      htmls = [_MISSING] * len(docs)
+    else:
+      htmls = [cache.get(s, _MISSING) for s in docs]
+    missing = [s for s, html in zip(docs, htmls) if html is _MISSING]
+    if missing:
+      rendered, error = self.pool.render(missing)
+      if error is not None:
+        return {"id": request_id, "error": error}
+      found = dict(zip(missing, rendered))
+      if cache is not None:
+        for s, html in found.iteritems():
+          cache.put(s, html)
+      htmls = [html if html is not _MISSING else found[s] for s, html in zip(docs, htmls)]
+    return {"id": request_id, "html": htmls}
+
+  def server_close(self):
+    SocketServer.UnixStreamServer.server_close(self)
+    self.pool.close()
+
+
+def main(argv=None):
+  "Runs the server with command-line arguments argv until SIGTERM or SIGINT; returns the exit status."
+  parser = optparse.OptionParser(usage="python -m stelm.server [options] socket_path",
+    description=__doc__.split("\n\n")[1].replace("\n", " "))
+  parser.add_option("-j", "--jobs", type="int", default=0, help="number of worker processes [number of CPUs]")
+  parser.add_option("-t", "--time-limit", type="float", default=5.0, help="seconds a request may take [%default]")
+  parser.add_option("--cache", type="int", default=10000, help="documents in the render cache [%default]")
+  parser.add_option("-c", "--config", metavar="FILE", help="JSON file to pass to combinator.configure()")
+  options, args = parser.parse_args(argv)
+  if len(args) != 1:
+    parser.error("need a socket path")
+  path = args[0]
+  initWorker(loadConfig(options.config))
+  warmup() # forked workers share the warmed-up state and inherit the configuration
+  jobs = options.jobs
+  if not jobs:
+    import multiprocessing
+    jobs = multiprocessing.cpu_count()
+  try:
+    os.unlink(path) # left over from a server that died
+  except OSError, e:
+    if e.errno != errno.ENOENT:
+      raise
+  server = RenderServer(path, WorkerPool(jobs, options.time_limit), options.cache)
+  def stop(signum, frame):
+    threading.Thread(target=server.shutdown).start() # shutdown() waits for serve_forever() to return
+  signal.signal(signal.SIGTERM, stop)
+  signal.signal(signal.SIGINT, stop)
+  started = time.time()
+  try:
+    server.serve_forever()
+  finally:
+    server.server_close()
+    os.unlink(path)
+  sys.stderr.write("stelm.server: %d requests, %d documents in %.0fs, %d workers replaced\n" % (
+    server.requests, server.documents, time.time() - started, server.pool.replaced))
+  return 0
+
+
+if __name__ == "__main__":
+  sys.exit(main())
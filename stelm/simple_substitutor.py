@@ -27,51 +27,116 @@
 
 import re
 
-def _produce(pattern, replacement):
+from fragments import Tag
+from context import DEFAULT_CONTEXT
 
-  PATTERN_RE = re.compile(pattern, re.U + re.MULTILINE)
 
-  class Substitutor(object):
+class _Substitutor(object):
+  """
+  Replaces group 1 of PATTERN_RE with a constant REPLACEMENT. Does not call other formatters.
+  """
+
+  @classmethod
+  def prepare(cls, **attrs):
+    "Patch the class with whatever we want"
+    for k,v in attrs.iteritems():
+      setattr(cls, k, v)
+    return cls
+
+  def __init__(self, s, pos, ctx=DEFAULT_CONTEXT):
+    self.source = s
+    self.boundary = pos
+    self.ctx = ctx
+    hit = self.PATTERN_RE.search(s, pos)
+    if hit is None:
+      self.start = self.end = None
+    else:
+      self.start = hit.start(1)
+      self.end = hit.end(1)
+
+  def getStart(self):
+    return self.start
+
+  def apply(self):
+    start, boundary, source = self.start, self.boundary, self.source
+    if start is not None:
+      res_list = []
+      start = self.start
+      if boundary != start:
+        res_list.append(source[boundary:start])
+      res_list.append(self.REPLACEMENT)
+      start = self.end
+      if self.ctx.stats is not None:
+        self.ctx.stats.count(self.STAT)
+    else:
+      # no start
+      start = boundary
+      res_list = []
+    return (res_list, start)
+
+
+def _produce(pattern, replacement, stat, trigger):
+
+  class Substitutor(_Substitutor):
+    def __str__(self):
+      return "%s(%r -> %r)%x" % (self.__class__.__name__, pattern, replacement, id(self))
+
+  return Substitutor.prepare(
+    PATTERN=pattern, PATTERN_RE=re.compile(pattern, re.U + re.MULTILINE),
+    REPLACEMENT=replacement, STAT=stat, TRIGGER=trigger
+  )
+
+
+class SubstitutionLane(object):
+  """
+  Applies a number of substitutors at once, with one combined regex and no bidding,
+  to the text before the place where a structural formatter is going to start.
+
+  A substitution that ends before that place cannot change what the structural formatters find,
+  so all such substitutions are done in one go. Which one wins and whether it wins over the structural
+  formatter is decided by the order of queue, exactly as it would be in applyQueue().
+  """
+
+  def __init__(self, substitutors, queue):
+    self.substitutors = tuple(substitutors)
+    self.regex = re.compile("|".join("(?:%s)" % sub.PATTERN for sub in substitutors), re.U + re.MULTILINE)
+    assert self.regex.groups == len(self.substitutors), "every substitutor pattern must have exactly one group"
+    self.rank = dict((proc_class, i) for i, proc_class in enumerate(queue))
+
+  def apply(self, s, pos, bet, candidate, hit, res_list, ctx):
     """
-    Replaces double minuses with em dashes.
-    To be replaced, '--' must encompassed be by whitespace, or begin at line start.
+    Substitute in s starting from pos, before candidate that is going to start at bet (or None, at len(s)).
+    hit is the previous result of self.regex.search(s, some position <= pos), or None if there was none.
+    Appends fragments to res_list. Returns (new pos, next hit, flag telling if the formatters must bid again).
     """
+    regex, substitutors = self.regex, self.substitutors
+    stats = ctx.stats
+    while True:
+      if hit is None or hit.start() < pos:
+        hit = regex.search(s, pos) # an older hit still is the leftmost one if it starts after pos
+        if hit is None:
+          return (pos, None, False)
+      index = hit.lastindex
+      start = hit.start(index)
+      sub = substitutors[index-1]
+      if start > bet or start == bet and candidate is not None and self.rank[candidate.__class__] < self.rank[sub]:
+        return (pos, hit, False)
+      if start != pos:
+        res_list.append(s[pos:start])
+      res_list.append(sub.REPLACEMENT)
+      if stats is not None:
+        stats.count(sub.STAT)
+      pos = hit.end(index)
+      if pos >= bet:
+        # may have eaten what the candidate's regex matched, e.g. the non-word before a marker
+        return (pos, hit, True)
+
 
-    def __init__(self, s, pos):
-      self.source = s
-      self.boundary = pos
-      hit = PATTERN_RE.search(s, pos)
-      if hit is None:
-        self.start = self.end = None
-      else:
-        self.start = hit.start(1)
-        self.end = hit.end(1)
-
-    def getStart(self):
-      return self.start
-
-    def apply(self):
-      start, boundary, source = self.start, self.boundary, self.source
-      if start is not None:
-        res_list = []
-        start = self.start
-        if boundary != start:
-          res_list.append(source[boundary:start])
-        res_list.append(replacement)
-        start = self.end
-      else:
-        # no start
-        start = boundary
-        res_list = []
-      return (res_list, start)
-
-  return Substitutor
-
-Dasher = _produce("(?:\s|^)(--)(?:\s)", u"\u2014")
+Dasher = _produce("(?:\s|^)(--)(?:\s)", u"\u2014", "dashes", "--")
 
 # matching the newline is a bit clumsy, but works
 NEWLINE = "\r\n|\n\r|\n|\r"
 SPC = "[ \t]*"
-HorizontalRuler = _produce("((?:"+NEWLINE+"|^)"+SPC+"-{3,}"+SPC+"(?:"+NEWLINE+"|$))", "<hr/>")
+HorizontalRuler = _produce("((?:"+NEWLINE+"|^)"+SPC+"-{3,}"+SPC+"(?:"+NEWLINE+"|$))", Tag(u"<hr/>", u"\n"), "rules", "---")
 
-LineBreaker = _produce(ur"((?:\n\r)|(?:\r\n)|\n|\r)", "<br/>")
\ No newline at end of file
+LineBreaker = _produce(ur"((?:\n\r)|(?:\r\n)|\n|\r)", Tag(u"<br/>", u"\n"), "line_breaks", r"\n|\r")
@@ -0,0 +1,245 @@
+# encoding: utf-8
+
+# Copyright 2010 by Dmitry Cheryasov. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without modification, are
+# permitted provided that the following conditions are met:
+#
+#    1. Redistributions of source code must retain the above copyright notice, this list of
+#       conditions and the following disclaimer.
+#
+#    2. Redistributions in binary form must reproduce the above copyright notice, this list
+#       of conditions and the following disclaimer in the documentation and/or other materials
+#       provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+# ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL COPYRIGHT HOLDER BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# ^^^ This is the "Simplified BSD License"
+
+
+"""
+Specialized render functions, generated and compiled for the current configuration.
+
+specialize() returns a function that does what format(s) does, for the formatters in QUEUE and the
+engine options as they are now. Its applyQueue() has the bidding of every formatter unrolled and the
+substitution lane inlined. A formatter class declares in BID the name of its regex and the group
+where its getStart() is; its last match is kept while it starts at or after the current position,
+since searching again would find it again. Only the winning formatter gets constructed.
+If some formatter is OPAQUE, the others search only before it, as in combinator.applySegmented().
+Nested parts, e.g. the inside of *bold*, are formatted by the generic engine.
+
+The generated source is in the .source attribute of the function. Functions are cached
+by a fingerprint of the configuration, so calling specialize() after every configure() is cheap.
+"""
+
+import combinator
+
+__all__ = ["specialize", "fingerprint"]
+
+_CACHE = {}
+
+
+def fingerprint():
+  "Returns a hashable description of everything the generated code depends on."
+  structural = []
+  for proc_class in combinator.STRUCTURAL:
+    bid = combinator.bidRegex(proc_class)
+    structural.append((proc_class, bid and (bid[0].pattern, bid[0].flags, bid[1]), getattr(proc_class, "OPAQUE", False)))
+  lane = combinator.LANE
+  trigger = combinator.TRIGGER_RE
+  return (
+    tuple(structural),
+    lane and tuple((sub, sub.REPLACEMENT, sub.STAT) for sub in lane.substitutors),
+    lane and lane.regex.pattern,
+    trigger and trigger.pattern,
+    combinator.ESCAPE_ON_EMIT, combinator.DEFERRING,
+  )
+
+def specialize():
+  "Returns a function of s that returns the same as format(s) under the current configuration."
+  key = fingerprint()
+  function = _CACHE.get(key)
+  if function is None:
+    source, namespace = _generate()
+    exec compile(source, "<stelm specialized %x>" % (hash(key) & 0xffffffff), "exec") in namespace
+    function = namespace["format"]
+    function.source = source
+    function.fingerprint = key
+    _CACHE[key] = function
+  return function
+
+def _generate():
+  "Returns (source of a module defining format() and applyQueue(), its globals)."
+  namespace = {
+    "DEFAULT_CONTEXT": combinator.DEFAULT_CONTEXT, "RAW_CONTEXT": combinator.Context(raw=True),
+    "html_escape": combinator.html_escape, "resolveDeferred": combinator.resolveDeferred,
+    "KEEP": (combinator.Tag, combinator.Escaped), "NO_MATCH": object(), "MARGIN": combinator.MARGIN,
+  }
+  lines = []
+  add = lines.append
+  structural = combinator.STRUCTURAL
+  lane = combinator.LANE
+  add("def applyQueue(s, ctx=DEFAULT_CONTEXT):")
+  add("  ret = []")
+  add("  append = ret.append")
+  add("  pos = 0")
+  add("  maxlen = len(s)")
+  segmented = combinator.segmentPlan(structural) is not None
+  opaque = [segmented and getattr(proc_class, "OPAQUE", False) for proc_class in structural]
+  for i in range(len(structural)):
+    add("  hit%d = None # not searched yet" % i)
+    if segmented and not opaque[i]:
+      add("  clear%d = 0 # no match up to this" % i)
+  if lane is not None:
+    add("  stats = ctx.stats")
+    add("  lane_hit = None")
+  add("  while pos < maxlen:")
+  names = dict((value, name) for name, value in vars(combinator).items() if value in structural) # produced classes share names
+  if segmented:
+    # where the first opaque region starts; the others search before it
+    add("    limit = maxlen")
+    for i, proc_class in enumerate(structural):
+      if opaque[i]:
+        regex, group = combinator.bidRegex(proc_class)
+        namespace["search%d" % i] = regex.search
+        add("    # %s" % names.get(proc_class, proc_class.__name__))
+        add("    if hit%d is not NO_MATCH:" % i)
+        add("      if hit%d is None or hit%d.start() < pos:" % (i, i))
+        add("        hit%d = search%d(s, pos) or NO_MATCH" % (i, i))
+        add("      if hit%d is not NO_MATCH and hit%d.start(%d) < limit:" % (i, i, group))
+        add("        limit = hit%d.start(%d)" % (i, group))
+  add("    bet = maxlen")
+  add("    winner = -1")
+  for i, proc_class in enumerate(structural):
+    namespace["Formatter%d" % i] = proc_class
+    add("    # %s" % names.get(proc_class, proc_class.__name__))
+    guard = i and "bet != pos and " or "" # at pos, nobody later can win
+    bid = combinator.bidRegex(proc_class)
+    if bid is None:
+      add("    if %sTrue:" % guard)
+      add("      hit%d = Formatter%d(s, pos, ctx)" % (i, i))
+      add("      take = hit%d.getStart()" % i)
+      add("      if take is not None and take < bet:")
+      add("        bet = take")
+      add("        winner = %d" % i)
+    else:
+      regex, group = bid
+      namespace["search%d" % i] = regex.search
+      if opaque[i]:
+        add("    if %shit%d is not NO_MATCH: # searched above" % (guard, i))
+        add("      if True:")
+      elif segmented:
+        add("    if %shit%d is not NO_MATCH:" % (guard, i))
+        add("      if hit%d is not None and hit%d.start() < pos:" % (i, i))
+        add("        hit%d = None" % i)
+        add("      if hit%d is None and clear%d <= limit:" % (i, i))
+        add("        if limit == maxlen or search%d(s, pos, limit + MARGIN) is not None:" % i)
+        add("          hit%d = search%d(s, pos) or NO_MATCH" % (i, i))
+        add("        else:")
+        add("          clear%d = limit + 1" % i)
+        add("      if hit%d is not None and hit%d is not NO_MATCH:" % (i, i))
+      else:
+        add("    if %shit%d is not NO_MATCH:" % (guard, i))
+        add("      if hit%d is None or hit%d.start() < pos:" % (i, i))
+        add("        hit%d = search%d(s, pos) or NO_MATCH" % (i, i))
+        add("      if hit%d is not NO_MATCH:" % i)
+      add("        take = hit%d.start(%d)" % (i, group))
+      add("        if take < bet:")
+      add("          bet = take")
+      add("          winner = %d" % i)
+  if lane is not None:
+    # substitutions before bet, see SubstitutionLane.apply()
+    ranks = [lane.rank[proc_class] for proc_class in structural]
+    namespace["lane_search"] = lane.regex.search
+    namespace["REPLACEMENTS"] = (None,) + tuple(sub.REPLACEMENT for sub in lane.substitutors)
+    namespace["STATS"] = (None,) + tuple(sub.STAT for sub in lane.substitutors)
+    # YIELDS[winner][index]: the substitution at bet loses to the formatter that bet
+    namespace["YIELDS"] = tuple((False,) + tuple(rank < lane.rank[sub] for sub in lane.substitutors) for rank in ranks)
+    add("    rebid = False")
+    add("    while lane_hit is not NO_MATCH:")
+    add("      if lane_hit is None or lane_hit.start() < pos:")
+    add("        lane_hit = lane_search(s, pos) or NO_MATCH")
+    add("        if lane_hit is NO_MATCH:")
+    add("          break")
+    add("      index = lane_hit.lastindex")
+    add("      start = lane_hit.start(index)")
+    add("      if start > bet or start == bet and winner >= 0 and YIELDS[winner][index]:")
+    add("        break")
+    add("      if start != pos:")
+    add("        append(s[pos:start])")
+    add("      append(REPLACEMENTS[index])")
+    add("      if stats is not None:")
+    add("        stats.count(STATS[index])")
+    add("      pos = lane_hit.end(index)")
+    add("      if pos >= bet:")
+    add("        rebid = True # the substitution may have eaten what the winner matched")
+    add("        break")
+    add("    if rebid:")
+    add("      continue")
+  for i in range(len(structural)):
+    add("    %s winner == %d:" % (i and "elif" or "if", i))
+    add("      frags, pos = Formatter%d(s, pos, ctx).apply()" % i)
+  if structural:
+    add("    else:")
+    add("      break")
+    add("    ret.extend(frags)")
+  else:
+    add("    break")
+  add("  if pos < maxlen:")
+  add("    append(s[pos:])")
+  add("  return ret")
+  add("")
+  add("def format(s):")
+  trigger = combinator.TRIGGER_RE
+  if trigger is not None:
+    namespace["trigger_search"] = trigger.search
+    add("  if trigger_search(s) is None:")
+    add("    return u\"\" + html_escape(s) # nothing to format")
+  raw = combinator.ESCAPE_ON_EMIT
+  if raw:
+    add("  frags = applyQueue(s, RAW_CONTEXT)")
+  else:
+    add("  frags = applyQueue(html_escape(s))")
+  if combinator.DEFERRING:
+    add("  frags = resolveDeferred(frags)")
+  if raw:
+    add("  if \"&\" in s or \"<\" in s or \">\" in s:")
+    add("    frags = [frag if frag.__class__ in KEEP else html_escape(frag) for frag in frags]")
+  add("  return u\"\".join(frags)")
+  return ("\n".join(lines) + "\n", namespace)
+
+def benchmark(repeat=3):
+  "Returns {corpus name: (seconds for format(), seconds for the specialized function)} over memcheck corpora."
+  import time
+  from memcheck import CORPORA, corpus
+  function = specialize()
+  results = {}
+  for name in sorted(CORPORA):
+    docs = corpus(name)
+    timings = []
+    for render in (combinator.format, function):
+      best = None
+      for i in range(repeat):
+        started = time.time()
+        for s in docs:
+          render(s)
+        elapsed = time.time() - started
+        best = best is None and elapsed or min(best, elapsed)
+      timings.append(best)
+    results[name] = tuple(timings)
+  return results
+
+
+if __name__ == "__main__":
+  print specialize().source
+  for name, (generic, specialized) in sorted(benchmark().items()):
+    print "# %-8s format() %.4fs, specialized %.4fs, %.2fx" % (name, generic, specialized, generic / specialized)
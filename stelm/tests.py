@@ -25,13 +25,40 @@
 #
 # ^^^ This is the "Simplified BSD License"
 
+import os
+import re
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from Queue import Full
+from StringIO import StringIO
+from cgi import escape as html_escape
 
 from marker_based import Boldfacer, Italicizer, Striker
 from preformatter import BlockCodeFormatter, InlineCodeFormatter
 from linker import Linker
 from simple_substitutor import Dasher, HorizontalRuler, LineBreaker
+from hashtagger import HashTagger
+from batch_resolver import MemoryResolver, TTLCache
 import combinator
+import linker
+import marker_based
+import fragments
+import cli
+import rerender
+import offload
+import server
+import client
+import memcheck
+import fuzz
+import specializer
+from extractor import extract, extractMany, Span
 
 class TMarkerBased(unittest.TestCase):
 
@@ -171,6 +198,523 @@ class TCombinator(unittest.TestCase):
     self.assertEqual(u"".join(frags), ur"<b>a\\*b</b>")
 
 
+class TPlainText(unittest.TestCase):
+
+  def testMarkersDropped(self):
+    s = u"a *b _c_* -d- \\*e & f < g"
+    self.assertEqual(combinator.formatText(s), u"a b c d *e & f < g")
+
+  def testNewlines(self):
+    s = u"a\nb\n---\nc -- d"
+    self.assertEqual(combinator.formatText(s), u"a\nb\nc \u2014 d")
+
+  def testCode(self):
+    s = u"x {{*y*}}\n{{\n<z>\n}}\nw"
+    self.assertEqual(combinator.formatText(s), u"x *y*\n\n<z>\nw")
+
+  def testLinks(self):
+    s = u'see http://a.b/?c&d and http://e.f|"the *E*"'
+    self.assertEqual(combinator.formatText(s), u"see http://a.b/?c&d and the E (http://e.f)")
+
+  def testBoth(self):
+    s = u"*a* http://b.c|d\ne"
+    self.assertEqual(combinator.formatBoth(s), (combinator.format(s), combinator.formatText(s)))
+
+
+class TStats(unittest.TestCase):
+
+  def testCounts(self):
+    s = u'*a* _b_ x*y {{c}} http://Ex.com/1|"*d*" ftp://ex.com, http://o.rg\n---\n-- e\n{{\nf\n}}'
+    html, stats = combinator.format(s, with_stats=True)
+    self.assertEqual(html, combinator.format(s))
+    self.assertEqual((stats.links, stats.emphasis, stats.inline_code, stats.code_blocks), (3, 3, 1, 1))
+    self.assertEqual(stats.domains, {"ex.com": 2, "o.rg": 1})
+    self.assertEqual((stats.rules, stats.dashes, stats.line_breaks), (1, 1, 1))
+
+  def testVisibleChars(self):
+    html, stats = combinator.format(u"*a&b* http://c.d|e", with_stats=True)
+    self.assertEqual(stats.visible_chars, len(u"a&b e"))
+
+
+class TFormatUtf8(unittest.TestCase):
+
+  SAMPLES = [u"caf\u00e9 & <b>", u"", u"\u00e9*b* \u00ab*c*\u00bb", u"\u00a0-- x\u3000--\u3000", u"\u0436 http://x.org/\u0436"]
+
+  def testSameAsFormat(self):
+    for s in self.SAMPLES:
+      html = combinator.formatUtf8(s.encode("utf-8"))
+      self.assertEqual(html.__class__, str)
+      self.assertEqual(html, combinator.format(s).encode("utf-8"))
+
+  def testStats(self):
+    html, stats = combinator.formatUtf8(u"*\u00e9*".encode("utf-8"), with_stats=True)
+    self.assertEqual(html, u"<b>\u00e9</b>".encode("utf-8"))
+    self.assertEqual((stats.emphasis, stats.visible_chars), (1, 1))
+
+
+class TFormatTo(unittest.TestCase):
+
+  def testSameAsFormat(self):
+    s = u"*caf\u00e9* http://x.org & {{<b>}}\n" * 5
+    out = StringIO()
+    written = combinator.formatTo(s, out)
+    self.assertEqual(out.getvalue(), combinator.format(s).encode("utf-8"))
+    self.assertEqual(written, len(out.getvalue()))
+
+  def testChunks(self):
+    s = u"_a_ b\n" * 100
+    out = StringIO()
+    try:
+      fragments.CHUNK_SIZE = 10
+      combinator.formatTo(s, out, "latin-1")
+    finally:
+      fragments.CHUNK_SIZE = 1 << 16
+    self.assertEqual(out.getvalue(), combinator.format(s).encode("latin-1"))
+
+  def testEscapedCopyNotHeld(self):
+    # an escaped copy of the text would take more than a byte per character
+    script = "\n".join([
+      "import gc, resource, combinator",
+      "class Null(object):",
+      "  def write(self, data): pass",
+      "s = u'a <to> b & c ' * 300000 + u'*x*'",
+      "gc.collect()",
+      "before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss",
+      "combinator.formatTo(s, Null())",
+      "print resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before, len(s)",
+    ])
+    output = subprocess.check_output([sys.executable, "-c", script], cwd=os.path.dirname(os.path.abspath(__file__)))
+    peak_kb, length = map(int, output.split())
+    self.assertTrue(peak_kb * 1024 < length, output)
+
+
+class TFormatStream(unittest.TestCase):
+
+  SNIPPETS = [u"*b* ", u"_i_ ", u"~s~ ", u"{{<x>}} ", u"{{{\na\n}}}\n", u"--\n", u"----\n", u"a -- b ",
+              u"http://ex.com/p ", u"#tag ", u"café & ", u"\\*no\\* ", u"x|\n", u"plain "]
+
+  class Reader(object):
+    """Returns a few bytes per read, so parts and multi-byte characters are cut anywhere."""
+
+    def __init__(self, data, size):
+      self.data, self.size, self.pos = data, size, 0
+
+    def read(self, n):
+      part = self.data[self.pos:self.pos + min(n, self.size)]
+      self.pos += len(part)
+      return part
+
+  def stream(self, s, lookahead, size=7, stats=None):
+    out = StringIO()
+    written = combinator.formatStream(self.Reader(s.encode("utf-8"), size), out, lookahead=lookahead, stats=stats)
+    self.assertEqual(written, len(out.getvalue()))
+    return out.getvalue().decode("utf-8")
+
+  def testSameAsFormat(self):
+    rnd = random.Random(47)
+    for _ in range(20):
+      s = u"".join(rnd.choice(self.SNIPPETS) for _ in range(rnd.randint(1, 60)))
+      self.assertEqual(self.stream(s, 30), combinator.format(s))
+      self.assertEqual(self.stream(s, None, 1000), combinator.format(s))
+
+  def testFarCloserStaysLiteral(self):
+    s = u"*a" + u" b" * 50 + u"*"
+    self.assertEqual(combinator.format(s)[:3], u"<b>")
+    self.assertEqual(self.stream(s, 20), s)
+
+  def testWritesWhileReading(self):
+    reader = self.Reader((u"_a_ b\n" * 2000).encode("utf-8"), 100)
+    seen = []
+    class Writer(object):
+      def write(self, data):
+        seen.append(reader.pos)
+    combinator.formatStream(reader, Writer(), lookahead=200)
+    self.assertTrue(seen[0] < len(reader.data))
+
+  def testStats(self):
+    s = u"*a* http://ex.com/x {{c}} b -- c\n" * 3
+    stats = combinator.Stats()
+    self.stream(s, 20, stats=stats)
+    self.assertEqual(stats.asDict(), combinator.format(s, with_stats=True)[1].asDict())
+
+
+class TCommandLine(unittest.TestCase):
+
+  def setUp(self):
+    self.folder = tempfile.mkdtemp()
+    os.makedirs(os.path.join(self.folder, "in", "sub"))
+    self.files = {"a.txt": u"*caf\u00e9*\n", os.path.join("sub", "b.txt"): u"plain & simple", "c.md": u"_no_"}
+    for name, text in self.files.items():
+      f = open(os.path.join(self.folder, "in", name), "wb")
+      f.write(text.encode("utf-8"))
+      f.close()
+
+  def tearDown(self):
+    shutil.rmtree(self.folder)
+
+  def readOutput(self, name):
+    f = open(os.path.join(self.folder, "out", name), "rb")
+    try:
+      return f.read().decode("utf-8")
+    finally:
+      f.close()
+
+  def testMirroredDirectory(self):
+    status = cli.main(["-q", "-j", "1", "-o", os.path.join(self.folder, "out"), os.path.join(self.folder, "in")])
+    self.assertEqual(status, 0)
+    for name in ("a", os.path.join("sub", "b")):
+      self.assertEqual(self.readOutput(name + ".html"), combinator.format(self.files[name + ".txt"]))
+    self.assertFalse(os.path.exists(os.path.join(self.folder, "out", "c.html")))
+
+  def testOutputCollision(self):
+    a, b = os.path.join(self.folder, "in", "a.txt"), os.path.join(self.folder, "in", "sub", "b.txt")
+    other_a = os.path.join(self.folder, "in", "sub", "a.txt")
+    shutil.copy(b, other_a)
+    out = os.path.join(self.folder, "out")
+    stderr = sys.stderr
+    try:
+      sys.stderr = StringIO()
+      self.assertEqual(cli.main(["-q", "-j", "1", "-o", out, a, other_a]), 2)
+      self.assertTrue("a.html" in sys.stderr.getvalue())
+    finally:
+      sys.stderr = stderr
+    self.assertFalse(os.path.exists(out))
+    self.assertEqual(cli.main(["-q", "-j", "2", "-o", out, a, b, a]), 0) # the same file twice is fine
+    self.assertEqual(sorted(os.listdir(out)), ["a.html", "b.html"])
+
+  def testMappedFile(self):
+    try:
+      cli.MMAP_THRESHOLD = 1
+      src, size, seconds, error, html = cli.convertFile(os.path.join(self.folder, "in", "a.txt"))
+    finally:
+      cli.MMAP_THRESHOLD = 1 << 20
+    self.assertEqual((size, error), (len(self.files["a.txt"].encode("utf-8")), None))
+    self.assertEqual(html.decode("utf-8"), combinator.format(self.files["a.txt"]))
+
+  def testMissingFile(self):
+    src, size, seconds, error, html = cli.convertFile(os.path.join(self.folder, "nope.txt"))
+    self.assertTrue(error)
+
+  def testRecords(self):
+    out = StringIO()
+    count = cli.convertRecords(StringIO("*a*\0b\nc\0"), out, "\0")
+    self.assertEqual(count, (2, 8))
+    self.assertEqual(out.getvalue(), "<b>a</b>\0b<br/>c\0")
+
+
+class TRerender(unittest.TestCase):
+
+  def setUp(self):
+    self.folder = tempfile.mkdtemp()
+    self.path = os.path.join(self.folder, "posts.db")
+    db = sqlite3.connect(self.path)
+    db.execute("CREATE TABLE posts (pid INTEGER PRIMARY KEY, body TEXT, html TEXT, hash TEXT)")
+    db.executemany("INSERT INTO posts (body) VALUES (?)", [(u"*%d* & #t" % i,) for i in range(10)])
+    db.commit()
+    db.close()
+
+  def tearDown(self):
+    shutil.rmtree(self.folder)
+    combinator.configure({"hashtags": None})
+
+  def rerender(self, *args, **kwargs):
+    return rerender.rerender(self.path, "posts", "pid", "body", "html", "hash", batch_size=4, *args, **kwargs)
+
+  def htmls(self):
+    db = sqlite3.connect(self.path)
+    try:
+      return [html for html, in db.execute("SELECT html FROM posts ORDER BY pid")]
+    finally:
+      db.close()
+
+  def testRenderAndSkip(self):
+    self.assertEqual(self.rerender(), (10, 10, 0))
+    self.assertEqual(self.htmls(), [combinator.format(u"*%d* & #t" % i) for i in range(10)])
+    db = sqlite3.connect(self.path)
+    db.execute("UPDATE posts SET body = ? WHERE pid = 3", (u"_edited_",))
+    db.commit()
+    db.close()
+    self.assertEqual(self.rerender(), (10, 1, 9))
+    self.assertEqual(self.htmls()[2], combinator.format(u"_edited_"))
+    self.assertEqual(self.rerender(), (10, 0, 10)) # nothing changed
+
+  def testResume(self):
+    def crash(rows, rendered, skipped, seconds):
+      if rows > 4:
+        raise KeyboardInterrupt
+    self.assertRaises(KeyboardInterrupt, self.rerender, report=crash)
+    self.assertEqual(self.htmls()[8:], [None, None])
+    self.assertEqual(self.rerender(), (2, 2, 0))
+
+  def testConfigChange(self):
+    self.rerender()
+    config = {"hashtags": {"url": "/t/"}}
+    combinator.configure(config)
+    self.assertEqual(self.rerender(config), (10, 10, 0))
+    self.assertEqual(self.htmls()[0], combinator.format(u"*0* & #t"))
+    self.assertTrue(u'href="/t/t"' in self.htmls()[0])
+
+
+class TOffloader(unittest.TestCase):
+
+  DOCS = [u"*a*", u"_long enough_ http://x.org", u"", u"plain and long enough"]
+
+  def setUp(self):
+    self.offloader = offload.Offloader(workers=2, threshold=10, max_pending=1)
+
+  def tearDown(self):
+    self.offloader.close()
+
+  def testSameAsFormat(self):
+    expected = [combinator.format(s) for s in self.DOCS]
+    self.assertEqual([future.result(5) for future in map(self.offloader.submit, self.DOCS)], expected)
+    self.assertEqual([future.result(5) for future in self.offloader.submitMany(self.DOCS)], expected)
+    self.assertEqual(list(self.offloader.imap(self.DOCS * 3)), expected * 3)
+
+  def testManyFormatsOnce(self):
+    calls = []
+    def counting(s, *args, **kwargs):
+      calls.append(s)
+      return format(s, *args, **kwargs)
+    format = combinator.format
+    offloader = offload.Offloader(workers=1, threshold=10, cache_size=0)
+    try:
+      combinator.format = offload.format = counting
+      futures = offloader.submitMany([u"*a*", u"_b_", u"*long enough*"])
+      self.assertEqual([future.result(5) for future in futures], [u"<b>a</b>", u"<i>b</i>", u"<b>long enough</b>"])
+    finally:
+      combinator.format = offload.format = format
+      offloader.close()
+    self.assertEqual(sorted(calls), [u"*a*", u"*long enough*", u"_b_"])
+
+  def testInline(self):
+    self.assertTrue(self.offloader.submit(u"*short*").done())
+    self.offloader.submit(self.DOCS[1]).result(5)
+    self.assertTrue(self.offloader.submit(self.DOCS[1]).done()) # from the cache
+
+  def testEmptyCached(self):
+    offloader = offload.Offloader(workers=1, threshold=0)
+    try:
+      offloader.submit(u"").result(5)
+      self.assertTrue(offloader.submit(u"").done()) # an empty result is a hit too
+    finally:
+      offloader.close()
+
+  def testBackpressure(self):
+    release = threading.Event()
+    def stuck(s):
+      release.wait(5)
+      return (s, None)
+    formatSafely = offload._formatSafely
+    try:
+      offload._formatSafely = stuck
+      done = []
+      first = self.offloader.submit(self.DOCS[1], done.append)
+      self.assertRaises(Full, self.offloader.submit, self.DOCS[3], block=False)
+      release.set()
+      self.assertEqual(first.result(5), self.DOCS[1])
+      self.assertEqual(done, [first])
+    finally:
+      offload._formatSafely = formatSafely
+
+  def testError(self):
+    future = self.offloader.submit("x" * 20 + "\xff") # not ASCII, not unicode
+    self.assertRaises(UnicodeDecodeError, future.result, 5)
+    self.assertRaises(offload.RenderTimeout, offload.RenderFuture().result, 0.01)
+
+
+def _slowRender(docs):
+  if u"slow" in docs:
+    time.sleep(10)
+  return combinator.formatMany(docs)
+
+class TRenderServer(unittest.TestCase):
+
+  def setUp(self):
+    self.folder = tempfile.mkdtemp()
+    self.path = os.path.join(self.folder, "stelm.sock")
+    renderDocs = server._renderDocs
+    try:
+      server._renderDocs = _slowRender # the worker processes fork with it
+      pool = server.WorkerPool(workers=1, time_limit=0.5)
+    finally:
+      server._renderDocs = renderDocs
+    self.server = server.RenderServer(self.path, pool)
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.start()
+    self.client = client.Client(self.path, timeout=5)
+
+  def tearDown(self):
+    self.client.close()
+    self.server.shutdown()
+    self.thread.join()
+    self.server.server_close()
+    shutil.rmtree(self.folder)
+
+  def testPipeline(self):
+    batches = [[u"*a*", u"b\nc"], [], [u"caf\u00e9 & http://x.org"]] * 3
+    expected = [[combinator.format(s) for s in docs] for docs in batches]
+    self.assertEqual(list(self.client.pipeline(batches, window=2)), expected)
+    self.assertEqual(self.client.format(u"*a*"), u"<b>a</b>")
+
+  def testPipelineOverSocketBuffers(self):
+    s = u"plain text " * 50000 # the requests and responses in flight don't fit in the socket buffers
+    batches = [[s]] * 16
+    expected = [combinator.format(s)]
+    self.assertEqual(list(self.client.pipeline(batches, window=2)), [expected] * 16)
+    answered = []
+    ahead = []
+    answer = self.server.answer
+    self.server.answer = lambda request: answered.append(request["id"]) or answer(request)
+    wfile = self.client.wfile
+    class Writer(object):
+      def write(self, data):
+        ahead.append(len(ahead) - len(answered)) # requests sent and not answered before this one
+        wfile.write(data)
+      def flush(self):
+        wfile.flush()
+    try:
+      self.client.wfile = Writer()
+      self.assertEqual(list(self.client.pipeline(batches[:4], window=2, window_bytes=len(s))), [expected] * 4)
+    finally:
+      self.client.wfile = wfile
+    self.assertEqual(ahead, [0] * 4) # one request at a time fits in window_bytes
+
+  def testTimeLimit(self):
+    self.assertRaises(client.RenderError, self.client.formatMany, [u"ok", u"slow"])
+    self.assertEqual(self.server.pool.replaced, 1)
+    self.assertEqual(self.client.formatMany([u"_ok_"]), [u"<i>ok</i>"]) # by a new worker
+
+  def testEmptyCached(self):
+    sent = []
+    render = self.server.pool.render
+    self.server.pool.render = lambda docs: sent.append(docs) or render(docs)
+    for i in range(2):
+      self.assertEqual(self.server.answer({"id": i, "docs": [u""]}), {"id": i, "html": [u""]})
+    self.assertEqual(sent, [[u""]]) # the second time from the cache
+
+  def testBadRequest(self):
+    server.writeMessage(self.client.wfile, {"id": 7, "docs": "not a list"})
+    self.client.wfile.flush()
+    self.assertRaises(client.RenderError, self.client.receive, 7)
+
+
+class TMemory(unittest.TestCase):
+
+  def testBaseline(self):
+    self.assertEqual(memcheck.compare(memcheck.measure(), memcheck.loadBaseline()), [])
+
+  def testPeakBaseline(self):
+    self.assertEqual(memcheck.compare(memcheck.measurePeak(), memcheck.loadBaseline()), [])
+
+  def testCompare(self):
+    baseline = {"chat/format": {"retained_objects": 0, "peak_rss_kb": 1000}}
+    self.assertEqual(memcheck.compare({"chat/format": {"retained_objects": 50, "peak_rss_kb": 3000}}, baseline), [])
+    self.assertEqual(len(memcheck.compare({"chat/format": {"retained_objects": 51, "peak_rss_kb": 3300}}, baseline)), 2)
+    self.assertEqual(len(memcheck.compare({"chat/Linker": {"retained_objects": 0}}, baseline)), 1)
+
+  def testFork(self):
+    results = memcheck.measureFork(children=1)
+    self.assertEqual(sorted(results), ["cold", "warm"])
+    for metrics in results.values():
+      self.assertTrue(metrics["first_request_ms"] > 0)
+
+  def testLeakFound(self):
+    leak = []
+    render = combinator.render
+    try:
+      combinator.render = lambda s: leak.append([s]) or render(s)
+      results = memcheck.measure()
+    finally:
+      combinator.render = render
+    self.assertTrue(results["chat/format"]["retained_objects"] > 100)
+
+
+class TFuzz(unittest.TestCase):
+
+  def tearDown(self):
+    combinator.configure({"hashtags": None})
+
+  def testEnginesAgree(self):
+    self.assertEqual(fuzz.fuzz(200, seed=1)[0], [])
+
+  def testWithHashtags(self):
+    combinator.configure({"hashtags": {}})
+    self.assertEqual(fuzz.fuzz(100, seed=2, classes=["random", "nested"])[0], [])
+
+  def testMismatchShrunk(self):
+    broken = lambda s: combinator.format(s).replace(u"<hr/>", u"<hr>")
+    mismatches, timings = fuzz.fuzz(50, engines={"broken": broken}, classes=["lines"])
+    self.assertEqual(mismatches, [("lines", "broken", u"---")])
+    self.assertEqual(sorted(timings["lines"]), ["broken"])
+
+  def testFormatterRegressionFound(self):
+    # the reference has formatter classes of its own
+    trimUrl = Linker.__dict__["trimUrl"]
+    try:
+      Linker.trimUrl = staticmethod(lambda source, start, end: end)
+      mismatches, timings = fuzz.fuzz(50, engines={"format": combinator.format}, classes=["links"])
+    finally:
+      Linker.trimUrl = trimUrl
+    self.assertNotEqual(mismatches, [])
+
+  def testShrink(self):
+    self.assertEqual(fuzz.shrink(u"abc*d*ef", lambda s: u"*d" in s), u"*d")
+
+
+class TSpecializer(unittest.TestCase):
+
+  SAMPLES = [
+    u"", u"plain & <simple>", u"#tag *a #b* http://x.org|\"*q*\" \\*", u"a\n*b*\n\n_c_ d",
+    u"x\n{{\ny\n}}\nz\r\n{{w}}", u"-- -a- --b-- ---\n---", u"*g\nh* http://i\n-- j", u"k \\\n-- l {{\n\\}}\n}}",
+  ]
+
+  def tearDown(self):
+    combinator.configure({"hashtags": None, "escape_on_emit": False})
+
+  def check(self):
+    function = specializer.specialize()
+    self.assertEqual([function(s) for s in self.SAMPLES], [combinator.format(s) for s in self.SAMPLES])
+
+  def testSameAsFormat(self):
+    self.check()
+    combinator.configure({"hashtags": {}, "escape_on_emit": True})
+    self.check()
+
+  def testCached(self):
+    function = specializer.specialize()
+    self.assertTrue(specializer.specialize() is function)
+    self.assertTrue("def applyQueue(s, ctx=DEFAULT_CONTEXT):" in function.source)
+    combinator.configure({"hashtags": {}})
+    self.assertFalse(specializer.specialize() is function)
+    self.assertTrue("# HashTagger" in specializer.specialize().source)
+    combinator.configure({"hashtags": None})
+    self.assertTrue(specializer.specialize() is function)
+
+
+class TEscapeOnEmit(unittest.TestCase):
+
+  SAMPLES = [
+    u"a < b && *c > d* {{<e>}}",
+    u"\\<*f* \\&_g_ \\&amp; -- h",
+    u"http://i/?j=1&k=2 http://l/<. http://m/&|n",
+    u'http://o/"<p>"|"q & r" s',
+    u"{{\n<pre> & \\}}\n}}\n#t&u",
+  ]
+
+  def tearDown(self):
+    combinator.configure({"escape_on_emit": False})
+
+  def testSameOutput(self):
+    expected = [combinator.formatBoth(s) for s in self.SAMPLES]
+    combinator.configure({"escape_on_emit": True})
+    self.assertEqual([combinator.formatBoth(s) for s in self.SAMPLES], expected)
+
+  def testTextFragmentsEscaped(self):
+    combinator.configure({"escape_on_emit": True})
+    self.assertEqual(combinator.render(u"*<a>*"), [u"<b>", u"&lt;a&gt;", u"</b>"])
+
+
 class TBlockCode(unittest.TestCase):
 
   def testOneLiner(self):
@@ -197,6 +741,43 @@ class TBlockCode(unittest.TestCase):
     frags = combinator.applyQueue(s)
     self.assertEqual(u"".join(frags), ur"remember: <b><pre>i += 1</pre></b> and only so!")
 
+class TCodeHook(unittest.TestCase):
+
+  SOURCE = u"a {{x<y & z}}\n{{\nline *1*\n\\}} end\n}}\nb {{x<y & z}}"
+
+  def setUp(self):
+    self.calls = []
+
+  def tearDown(self):
+    combinator.configure({"code_hook": None, "escape_on_emit": False})
+
+  def hook(self, text, kind):
+    self.calls.append((text, kind))
+    return u"<span>%s</span>" % html_escape(text.upper())
+
+  def testHook(self):
+    combinator.configure({"code_hook": self.hook})
+    expected = u"a <code><span>X&lt;Y &amp; Z</span></code><br/><pre><span>LINE *1*\n}} END</span></pre>b <code><span>X&lt;Y &amp; Z</span></code>"
+    self.assertEqual(combinator.format(self.SOURCE), expected)
+    self.assertEqual(self.calls, [(u"x<y & z", "inline"), (u"line *1*\n}} end", "block")])
+    self.assertEqual(combinator.formatText(self.SOURCE), u"a x<y & z\n\nline *1*\n}} end\nb x<y & z")
+    combinator.configure({"escape_on_emit": True})
+    self.assertEqual(combinator.format(self.SOURCE), expected)
+    self.assertEqual(len(self.calls), 2) # cached
+
+  def testPool(self):
+    combinator.configure({"code_hook": self.hook, "code_workers": 2})
+    html = combinator.format(self.SOURCE)
+    combinator.configure({"code_hook": self.hook})
+    self.assertEqual(html, combinator.format(self.SOURCE))
+
+  def testOff(self):
+    combinator.configure({"code_hook": self.hook})
+    combinator.configure({"code_hook": None})
+    self.assertEqual(combinator.format(u"{{<a>}}"), u"<code>&lt;a&gt;</code>")
+    self.assertEqual(self.calls, [])
+
+
 class TInlineCode(unittest.TestCase):
 
   def testOneLiner(self):
@@ -334,6 +915,401 @@ class TLinker(unittest.TestCase):
     self.assertEqual(u"".join(frags), u'abc <a href="http://d.e.f?&lt;a&gt;+&quot;b&quot;">foo</a>')
     self.assertEqual(next, s.index(" ghi"))
 
+
+class TLinkScanner(unittest.TestCase):
+
+  PIECES = [u"://", u":", u"/", u"a", u"Z", u"9", u"-", u" ", u"\t", u"\n", u"\x0b", u"\xa0", u"|", u"\u00e9", u"(", u")", u"."]
+
+  def same(self, s, pos):
+    regex = re.compile(linker.LINK_PATTERN)
+    found = []
+    for hit in (regex.search(s, pos), Linker.LINK_RE.search(s, pos)):
+      found.append(hit and (hit.start(), hit.end(1), hit.end(), hit.groups()))
+    self.assertEqual(found[0], found[1], repr((s, pos)))
+
+  def testSameAsRegex(self):
+    for s in [u"http://x", u"ab:// cd://e|f", u"x://|y", u"a-b://c\n", u"\u00e9http://x y", u"://x", u"1://\xa0 z"]:
+      for pos in range(len(s) + 1):
+        self.same(s, pos)
+
+  def testRandom(self):
+    rnd = random.Random(1)
+    for i in range(3000):
+      s = u"".join(rnd.choice(self.PIECES) for j in range(rnd.randint(0, 12)))
+      self.same(s, rnd.randint(0, len(s)))
+
+
+class TLinkResolver(unittest.TestCase):
+
+  def setUp(self):
+    Linker.configure({"protocol_classes": {"http": None, "https": "https"}})
+    self.resolver = MemoryResolver({
+      u"http://a.b/?x=1&y=2": (u"/out?u=a.b&x=1", None),
+      u"https://home/": (u"https://home/", u"internal"),
+      u"http://bad/": (None, None),
+    })
+    combinator.configure({"link_resolver": self.resolver})
+
+  def tearDown(self):
+    combinator.configure({"link_resolver": None})
+
+  def testRewritten(self):
+    s = u"see http://a.b/?x=1&y=2, or https://home/|*home*"
+    self.assertEqual(combinator.format(s),
+      u'see <a href="/out?u=a.b&amp;x=1">http://a.b/?x=1&amp;y=2</a>, '
+      u'or <a href="https://home/" class="https internal"><b>home</b></a>')
+
+  def testBlockedAndUnknown(self):
+    s = u'http://bad/|"not this" but http://c.d'
+    self.assertEqual(combinator.format(s), u'not this but <a href="http://c.d">http://c.d</a>')
+
+  def testOneBatchCached(self):
+    combinator.format(u"http://bad/ http://c.d http://bad/")
+    combinator.format(u"http://c.d https://home/")
+    self.assertEqual(self.resolver.batches,
+      [frozenset([u"http://bad/", u"http://c.d"]), frozenset([u"https://home/"])])
+
+class THashTagger(unittest.TestCase):
+
+  def tearDown(self):
+    combinator.configure({"hashtags": None})
+    HashTagger.RESOLVER = None
+    HashTagger.TAG_URL = u"/tag/"
+
+  def testDefaultsRestored(self):
+    combinator.configure({"hashtags": {"url": "/t/"}})
+    combinator.configure({"hashtags": None})
+    combinator.configure({"hashtags": {}})
+    self.assertTrue(u'href="/tag/b"' in combinator.format(u"a #b"))
+    combinator.configure({"hashtags": {"url": "/t/"}})
+    combinator.configure({"hashtags": {}})
+    self.assertEqual(HashTagger.TAG_URL, u"/tag/")
+
+  def testSimple(self):
+    s = u"abc #def ghi"
+    f = HashTagger(s, 0)
+    frags, next = f.apply()
+    self.assertEqual(u"".join(frags), u'abc <a href="/tag/def">#def</a>')
+    self.assertEqual(next, s.index(" ghi"))
+
+  def testBOL(self):
+    s = u"#abc def"
+    f = HashTagger(s, 0)
+    self.assertEqual(f.getStart(), 0)
+
+  def testTrailingUnderscore(self):
+    combinator.configure({"hashtags": {}})
+    s = u"_Italic #foo_ bar"
+    self.assertEqual(combinator.format(s), u'<i>Italic <a href="/tag/foo">#foo</a></i> bar')
+
+  def testOffByDefault(self):
+    self.assertEqual(combinator.format(u"a #b"), u"a #b")
+
+  def testConfiguredUrl(self):
+    combinator.configure({"hashtags": {"url": u"/t/"}})
+    self.assertEqual(combinator.format(u"a #b"), u'a <a href="/t/b">#b</a>')
+    combinator.configure({"hashtags": None})
+    self.assertEqual(combinator.format(u"a #b"), u"a #b")
+
+  def testResolvedInOneBatch(self):
+    resolver = MemoryResolver({u"foo": u"foo", u"Bar": u"bar"})
+    combinator.configure({"hashtags": {"resolver": resolver}})
+    s = u"#foo and *#Bar*, again #foo; not #banned"
+    self.assertEqual(combinator.format(s),
+      u'<a href="/tag/foo">#foo</a> and <b><a href="/tag/bar">#Bar</a></b>, '
+      u'again <a href="/tag/foo">#foo</a>; not #banned')
+    self.assertEqual(resolver.batches, [frozenset([u"foo", u"Bar", u"banned"])])
+
+  def testAnswersCached(self):
+    resolver = MemoryResolver({u"foo": u"foo"})
+    combinator.configure({"hashtags": {"resolver": resolver}})
+    combinator.format(u"#foo #bar")
+    combinator.format(u"#bar #foo #baz")
+    self.assertEqual(resolver.batches, [frozenset([u"foo", u"bar"]), frozenset([u"baz"])])
+
+
+class TCaches(unittest.TestCase):
+
+  def testSizeBound(self):
+    cache = TTLCache(size=2, ttl=10)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    cache.get("a")
+    cache.put("c", 3) # evicts b, the least recently used
+    self.assertEqual((cache.get("a"), cache.get("b"), cache.get("c")), (1, None, 3))
+
+  def testExpiry(self):
+    now = [100]
+    cache = TTLCache(size=2, ttl=10, clock=lambda: now[0])
+    cache.put("a", None)
+    self.assertEqual(cache.get("a", "missing"), None)
+    now[0] = 111
+    self.assertEqual(cache.get("a", "missing"), "missing")
+    self.assertEqual(len(cache), 0)
+
+
+class TExtractor(unittest.TestCase):
+
+  def testLinksAndTags(self):
+    s = u"see http://a.b/c). and #tag_ or http://d.e/#frag|*named*"
+    self.assertEqual(extract(s), [
+      Span("link", 4, 16, u"http://a.b/c"),
+      Span("hashtag", 23, 27, u"tag"),
+      Span("link", 32, 48, u"http://d.e/#frag"),
+    ])
+
+  def testCodeIsOpaque(self):
+    s = u"a {{http://x #y}} b\\#z \\#w"
+    self.assertEqual(extract(s), [Span("code", 2, 17, u"http://x #y")])
+
+  def testBlockWithEscape(self):
+    s = u"code:\n{{\n\\}} #no\n}}\n#yes"
+    spans = extract(s, kinds=("code", "hashtag"))
+    self.assertEqual([(span.kind, span.value) for span in spans], [("code", u"}} #no"), ("hashtag", u"yes")])
+
+  def testKinds(self):
+    s = u"#a http://b/#c {{d}}"
+    self.assertEqual(extract(s, kinds=("hashtag",)), [Span("hashtag", 0, 2, u"a")])
+    self.assertRaises(ValueError, extract, s, kinds=("links",))
+
+  def linkedByFormat(self, s):
+    return re.findall(r'<a href="([^"]*)"', combinator.format(s))
+
+  def testLinkInMarkers(self):
+    for s, url in [(u"*see http://x.com*", u"http://x.com"), (u"x*http://x.com* y", u"http://x.com*"),
+                   (u"_a http://x.com/b_ c", u"http://x.com/b")]:
+      self.assertEqual([span.value for span in extract(s)], [url])
+      self.assertEqual(self.linkedByFormat(s), [url])
+
+  def testLinksAsFormat(self):
+    pieces = [u"*", u"_", u"-", u" ", u"\n", u"http://a.b/", u"x", u"|", u'"', u"{{", u"}}", u"\\", u".", u")", u"--", u"---\n"]
+    rnd = random.Random(28)
+    for i in range(500):
+      s = u"".join(rnd.choice(pieces) for j in range(rnd.randint(1, 20)))
+      urls = [html_escape(span.value, True) for span in extract(s, kinds=("link",))]
+      self.assertEqual(urls, self.linkedByFormat(s), s)
+
+  LINK_HEAVY = [u"word ", u"more words. ", u"\n", u"*bold http://example.com/a* ", u"_it_ ", u"http://example.com/a ",
+    u'http://x.org|"text _it_" ', u"http://y.org|name ", u"{{code}} ", u"<&>"]
+
+  def testBuildsNoMarkup(self):
+    def fail(*args):
+      self.fail("markup built")
+    rnd = random.Random(28)
+    docs = [u"".join(rnd.choice(self.LINK_HEAVY) for i in range(50)) + u" #tag" for j in range(20)]
+    saved = (marker_based._MarkerBased.getOpening, Linker.renderOpening, HashTagger.renderTag)
+    try:
+      marker_based._MarkerBased.getOpening = Linker.renderOpening = HashTagger.renderTag = fail
+      self.assertTrue(all(extractMany(docs)))
+    finally:
+      marker_based._MarkerBased.getOpening, Linker.renderOpening, HashTagger.renderTag = saved
+
+  def testFasterThanFormat(self):
+    rnd = random.Random(28)
+    docs = [u"".join(rnd.choice(self.LINK_HEAVY) for i in range(300)) for j in range(30)]
+    times = {extract: [], combinator.format: []}
+    for i in range(5): # interleaved, so that a busy moment slows both down
+      for function, function_times in times.items():
+        started = time.time()
+        for s in docs:
+          function(s)
+        function_times.append(time.time() - started)
+    self.assertTrue(min(times[extract]) < min(times[combinator.format]))
+
+  def testMany(self):
+    self.assertEqual(extractMany([u"#a", u"", u"http://b"], kinds=("link",)), [[], [], [Span("link", 0, 8, u"http://b")]])
+
+
+class TSubstitutionLane(unittest.TestCase):
+
+  SAMPLES = [
+    u"a\n*b*\n\n_c_ d", u"x\n{{\ny\n}}\nz\r\n{{w}}", u"-- -a- --b-- ---\n---", u"e\n---\n-- f\n\r\r\n",
+    u"*g\nh* http://i\n-- j", u"k \\\n-- l {{\n\\}}\n}}",
+  ]
+
+  def testSameAsBidding(self):
+    expected = [combinator.formatBoth(s) for s in self.SAMPLES]
+    try:
+      combinator.STRUCTURAL, combinator.LANE = combinator.QUEUE, None # all formatters bid
+      self.assertEqual([combinator.formatBoth(s) for s in self.SAMPLES], expected)
+    finally:
+      combinator.prepareQueue()
+
+  def testFragments(self):
+    frags = combinator.applyQueue(u"a\nb -- c\n")
+    self.assertEqual(frags, [u"a", u"<br/>", u"b ", u"\u2014", u" c", u"<br/>"])
+
+
+class TSegmented(unittest.TestCase):
+
+  PIECES = [
+    u"{{", u"}}", u"\\}}", u"\\", u"\n", u"\r", u" ", u"*", u"_", u"-", u"--", u"---", u"http://a", u"ab://", u"|", u"#t", u"x", u"\"",
+  ]
+
+  def tearDown(self):
+    combinator.configure({"hashtags": None})
+    combinator._PLANS.clear()
+
+  def unsegmented(self, s):
+    plans = dict(combinator._PLANS)
+    try:
+      combinator._PLANS[combinator.STRUCTURAL] = None
+      return combinator.formatBoth(s)
+    finally:
+      combinator._PLANS.clear()
+      combinator._PLANS.update(plans)
+
+  def testSameAsBidding(self):
+    combinator.configure({"hashtags": {}})
+    rnd = random.Random(2)
+    for i in range(3000):
+      s = u"".join(rnd.choice(self.PIECES) for j in range(rnd.randint(1, 20)))
+      self.assertEqual(combinator.formatBoth(s), self.unsegmented(s), repr(s))
+
+  def testCodeNotSearched(self):
+    s = u"*a* {{\n%s\n}} *b* {{%s}} *c*" % (u"*x* " * 100, u"*y* " * 100)
+    code = [(s.index(u"{{"), s.index(u"}}")), (s.rindex(u"{{"), s.rindex(u"}}"))]
+    scanned = [] # how far every search looked
+    regex = Boldfacer.START_RE
+    class Spy(object):
+      def search(self, s, pos=0, endpos=None):
+        hit = regex.search(s, pos, len(s) if endpos is None else endpos)
+        scanned.append(endpos or (hit and hit.end() or len(s)))
+        return hit
+    expected = self.unsegmented(s)
+    combinator._PLANS.clear()
+    try:
+      Boldfacer.START_RE = Spy()
+      self.assertEqual(combinator.formatBoth(s), expected)
+    finally:
+      Boldfacer.START_RE = regex
+    self.assertTrue(scanned)
+    for start, end in code:
+      self.assertFalse([far for far in scanned if start + combinator.MARGIN < far < end])
+
+  def testPlan(self):
+    self.assertNotEqual(combinator.segmentPlan(combinator.STRUCTURAL), None)
+    self.assertEqual(combinator.segmentPlan((Linker, Boldfacer)), None) # nothing opaque
+    self.assertEqual(combinator.segmentPlan(combinator.QUEUE), None) # substitutors have no BID
+
+
+class TFeatureMasks(unittest.TestCase):
+
+  SAMPLE = u"*a http://b/ c* _d_ -- e\n{{\nf\n}}\n{{g}} \\* #h\n---\n"
+
+  def tearDown(self):
+    combinator.configure({"hashtags": None})
+
+  def withQueue(self, queue):
+    "What format() gives with QUEUE swapped, as was done before masks"
+    saved = combinator.QUEUE
+    try:
+      combinator.QUEUE = queue
+      combinator.prepareQueue()
+      return combinator.format(self.SAMPLE)
+    finally:
+      combinator.QUEUE = saved
+      combinator.prepareQueue()
+
+  def testDisable(self):
+    self.assertEqual(combinator.format(u"*see http://x/*", disable=("links",)), u"<b>see http://x/</b>")
+    self.assertEqual(combinator.format(u"a\nb", disable=["line_breaks"]), u"a\nb")
+
+  def testEnable(self):
+    self.assertEqual(combinator.format(u"*a* _b_ http://c", enable=("bold",)), u"<b>a</b> _b_ http://c")
+    self.assertEqual(combinator.format(u"*a* _b_", enable=()), u"*a* _b_")
+
+  def testSameAsQueue(self):
+    combinator.configure({"hashtags": {}})
+    names = sorted(combinator.FEATURES)
+    rnd = random.Random(3)
+    for i in range(30):
+      disabled = rnd.sample(names, rnd.randint(0, len(names)))
+      queue = combinator.variant(disable=disabled).queue
+      self.assertEqual(combinator.format(self.SAMPLE, disable=disabled), self.withQueue(queue), disabled)
+    self.assertEqual(combinator.format(self.SAMPLE), self.withQueue(combinator.QUEUE)) # global state untouched
+
+  def testStats(self):
+    html, stats = combinator.format(u"*a* http://b", True, disable=("emphasis",))
+    self.assertEqual((html, stats.emphasis, stats.links), (u'*a* <a href="http://b" class="http">http://b</a>', 0, 1))
+
+  def testCache(self):
+    pipeline = combinator.variant(disable=["links"])
+    self.assertTrue(combinator.variant(disable=("links",)) is pipeline)
+    self.assertFalse(Linker in pipeline.structural)
+    combinator.configure({})
+    self.assertFalse(combinator.variant(disable=("links",)) is pipeline)
+
+  def testUnknown(self):
+    self.assertRaises(ValueError, combinator.format, u"a", disable=("blink",))
+
+
+class TWarmup(unittest.TestCase):
+
+  def tearDown(self):
+    combinator.configure({"hashtags": None, "link_resolver": None, "code_hook": None})
+
+  def testResolversNotCalled(self):
+    calls = []
+    def resolve(keys):
+      calls.append(keys)
+      return {}
+    def hook(text, kind):
+      calls.append(text)
+      return text
+    combinator.configure({"hashtags": {"resolver": resolve}, "link_resolver": resolve, "code_hook": hook})
+    resolvers = (Linker.RESOLVER, HashTagger.RESOLVER, BlockCodeFormatter.RESOLVER)
+    combinator.warmup()
+    self.assertEqual(calls, [])
+    self.assertEqual((Linker.RESOLVER, HashTagger.RESOLVER, BlockCodeFormatter.RESOLVER), resolvers)
+    self.assertEqual(len(Linker.RESOLVER.cache), 0)
+    combinator.format(u"http://a.b #c {{d}}")
+    self.assertEqual(len(calls), 3)
+
+  def testStateBuilt(self):
+    combinator.configure({"hashtags": {}})
+    combinator.warmup(variants=[(None, ["links"])])
+    self.assertTrue(combinator.STRUCTURAL in combinator._PLANS)
+    pipeline = combinator.variant(disable=["links"])
+    self.assertTrue(pipeline.structural in combinator._PLANS)
+    self.assertTrue(specializer.fingerprint() in specializer._CACHE)
+
+  def testNoChange(self):
+    docs = [u"*a* {{b}} http://c.d\n#e", u"x -- y"]
+    before = [combinator.format(s) for s in docs]
+    combinator.warmup(docs)
+    self.assertEqual([combinator.format(s) for s in docs], before)
+
+  def testCorpus(self):
+    # every formatter has something to do in the canned corpus
+    for proc_class in combinator.QUEUE + combinator.OPTIONAL_FORMATTERS:
+      self.assertTrue(any(re.search(proc_class.TRIGGER, s) for s in combinator.WARMUP_CORPUS), proc_class)
+
+
+class TFormatMany(unittest.TestCase):
+
+  DOCS = [
+    u"ok", u"", u"a < b & c", u"*hi*", u"ok", u"see http://x.org", u"#tag", u"a\nb", u"\0", u"ok \0 *yes*",
+  ]
+
+  def tearDown(self):
+    combinator.configure({"hashtags": None, "escape_on_emit": False})
+
+  def testSameAsFormat(self):
+    self.assertEqual(combinator.formatMany(self.DOCS), [combinator.format(s) for s in self.DOCS])
+
+  def testConfigured(self):
+    combinator.configure({"hashtags": {}, "escape_on_emit": True})
+    self.assertEqual(combinator.formatMany(self.DOCS), [combinator.format(s) for s in self.DOCS])
+
+  def testWithoutTriggers(self):
+    try:
+      combinator.TRIGGER_RE = None
+      self.assertEqual(combinator.formatMany(self.DOCS[:4]), [u"ok", u"", u"a &lt; b &amp; c", u"<b>hi</b>"])
+    finally:
+      combinator.prepareQueue()
+
+
 class TBreaker(unittest.TestCase):
 
   def testN(self):